@@ -12,6 +12,22 @@ import pandas as pd
 import uuid
 import calendar as py_calendar
 from collections import defaultdict
+import os
+import re
+import hashlib
+import tempfile
+import threading
+import queue
+import zlib
+import base64
+import contextlib
+import functools
+import sqlite3
+import io
+import logging
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
 
 # --- 1. 系統設定 ---
 st.set_page_config(page_title="鳩特數理行政班表", page_icon="🏫", layout="wide")
@@ -38,6 +54,7 @@ st.markdown("""
 
 if 'user' not in st.session_state: st.session_state['user'] = None
 if 'is_admin' not in st.session_state: st.session_state['is_admin'] = False
+if 'login_at' not in st.session_state: st.session_state['login_at'] = None
 
 # 初始化 Firebase
 if not firebase_admin._apps:
@@ -61,95 +78,566 @@ ADMIN_PASSWORD = "150508"
 
 GRADE_OPTIONS = ["小一", "小二", "小三", "小四", "小五", "小六", "國一", "國二", "國三", "高一", "高二", "高三", "畢業"]
 TIME_OPTIONS = [f"{h:02d}:00" for h in range(9, 23)] + [f"{h:02d}:30" for h in range(9, 22)]
+NOTICE_CATEGORIES = ["調課", "考試", "活動", "任務", "其他"]
+NOTICE_COLORS = {"調課": "#d63384", "考試": "#dc3545", "活動": "#0d6efd", "任務": "#FF4500", "其他": "#ffc107"}
+
+# 靜態班表匯出 (給家長/老師訂閱用，可直接以靜態檔案伺服器提供)
+EXPORT_DIR = "public_export"
+
+# --- 分校 (租戶) ---
+# 各分校資料放在 tenants/<代號>/<集合>；legacy_root 的分校沿用原本的根目錄集合，舊資料不用搬。
+# 可在 st.secrets["tenants"] 設定 (格式同 DEFAULT_TENANTS)，未設定的欄位沿用預設值。
+DEFAULT_TENANTS = {"main": {"name": "鳩特數理", "legacy_root": True}}
+CLEANING_AREAS = ["櫃檯茶水間", "大教室", "小教室", "流放教室", "鳩辦公室"]
+
+def _load_tenants():
+    try:
+        if "tenants" not in st.secrets: return DEFAULT_TENANTS
+    except: return DEFAULT_TENANTS
+    try:
+        raw = st.secrets["tenants"]
+        tenants = json.loads(raw) if isinstance(raw, str) else {k: dict(v) for k, v in raw.items()}
+        if tenants: return tenants
+    except Exception as e:
+        st.error(f"分校設定格式錯誤，使用預設設定: {e}")
+    return DEFAULT_TENANTS
+
+TENANTS = _load_tenants()
+DEFAULT_TENANT = next(iter(TENANTS))
+
+# 跨分校總表與重算只開放給 st.secrets["super_admins"] 列出的管理員，各分校管理員只看得到自己的分校
+def _load_super_admins():
+    try: return list(st.secrets.get("super_admins", []))
+    except: return []
+
+SUPER_ADMINS = _load_super_admins()
+
+def is_super_admin():
+    return bool(st.session_state.get('is_admin')) and st.session_state.get('user') in SUPER_ADMINS
+_tenant_local = threading.local()
+
+def current_tenant():
+    """背景執行緒以 tenant_scope 指定分校，頁面則使用登入時選擇的分校"""
+    tenant = getattr(_tenant_local, "tenant", None)
+    if tenant: return tenant
+    try: tenant = st.session_state.get('tenant')
+    except: tenant = None
+    return tenant if tenant in TENANTS else DEFAULT_TENANT
+
+@contextlib.contextmanager
+def tenant_scope(tenant):
+    prev = getattr(_tenant_local, "tenant", None)
+    _tenant_local.tenant = tenant
+    try: yield
+    finally: _tenant_local.tenant = prev
+
+def tenant_config(key, default=None, tenant=None):
+    return TENANTS.get(tenant or current_tenant(), {}).get(key, default)
+
+def tenant_col(name, tenant=None):
+    tenant = tenant or current_tenant()
+    if TENANTS.get(tenant, {}).get("legacy_root"): return db.collection(name)
+    return db.collection("tenants").document(tenant).collection(name)
+
+def tenant_cache(cache_decorator):
+    """st.cache_data / st.cache_resource 依分校分開快取：@tenant_cache(st.cache_data(ttl=300))。
+    分校代號是快取鍵的一部分，各分校的快取與一次性遷移互不影響；.clear() 清除所有分校。"""
+    def decorator(fn):
+        def per_tenant(tenant, *args, **kwargs):
+            with tenant_scope(tenant): return fn(*args, **kwargs)
+        # Streamlit 以函式名稱與原始碼區分快取，改名避免所有包裝函式共用同一份快取
+        per_tenant.__module__, per_tenant.__name__, per_tenant.__qualname__ = fn.__module__, fn.__name__, f"{fn.__qualname__}@tenant"
+        cached = cache_decorator(per_tenant)
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs): return cached(current_tenant(), *args, **kwargs)
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorator
 
 # --- 3. 資料庫存取 ---
 
+# 補習班所在地 (台北) 的時間；伺服器時區不一定是台北，記錄與比較時間都以此為準
+def taipei_now():
+    return datetime.datetime.now(pytz.timezone('Asia/Taipei'))
+
+def taipei_today():
+    return taipei_now().date()
+
+# --- 異動紀錄 (audit_log) ---
+# 每次寫入都記下 誰 / 何時 / 哪個函式 / 異動前後的內容，由背景執行緒批次寫入，不拖慢按鈕反應。
+# 舊紀錄每天由排程壓縮成 audit_snapshots (每份文件在壓縮時間點的最後狀態)，還原時只需讀少量文件。
+# ts 是帶時區的台北時間字串 (固定到微秒，可直接以字串比較)；早期沒有時區的紀錄視為台北時間。
+AUDIT_FLUSH_SECONDS = 2
+AUDIT_RETENTION_DAYS = 30
+AUDIT_MAX_ATTEMPTS = 5  # 同一批連續寫入失敗超過此次數就放棄，避免無限重試
+
+def _audit_encode(value):
+    """異動內容存成 JSON 字串；超過 100KB 時壓縮，避免超出 Firestore 單一文件上限"""
+    if value is None: return None
+    raw = json.dumps(value, ensure_ascii=False, default=str)
+    if len(raw) > 100_000: return {"z": base64.b64encode(zlib.compress(raw.encode("utf-8"))).decode("ascii")}
+    return raw
+
+def _audit_decode(value):
+    if value is None: return None
+    if isinstance(value, dict) and "z" in value: return json.loads(zlib.decompress(base64.b64decode(value["z"])).decode("utf-8"))
+    return json.loads(value)
+
+def _current_actor():
+    try: return st.session_state.get('user') or "system"
+    except: return "system"
+
+class _AuditWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.attempts = {}
+        threading.Thread(target=self._run, name="audit-writer", daemon=True).start()
+
+    def put(self, entry):
+        self.queue.put(entry)
+
+    def _run(self):
+        while True:
+            entries = [self.queue.get()]
+            deadline = time.time() + AUDIT_FLUSH_SECONDS
+            while len(entries) < 400:
+                try: entries.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty: break
+            try:
+                batch = db.batch()
+                for e in entries: batch.set(tenant_col("audit_log", e.get("tenant")).document(e["id"]), e)
+                batch.commit()
+                for e in entries: self.attempts.pop(e["id"], None)
+            except Exception as ex:
+                # 文件 ID 固定，重送不會重複
+                dropped = []
+                for e in entries:
+                    self.attempts[e["id"]] = self.attempts.get(e["id"], 0) + 1
+                    if self.attempts[e["id"]] < AUDIT_MAX_ATTEMPTS: self.queue.put(e)
+                    else:
+                        self.attempts.pop(e["id"])
+                        dropped.append(e["target"])
+                if dropped: logger.error("audit log flush failed %d times, dropped %d entries (%s): %s", AUDIT_MAX_ATTEMPTS, len(dropped), ", ".join(dropped[:5]), ex)
+                else: logger.warning("audit log flush failed, retrying: %s", ex)
+                time.sleep(5)
+
+@st.cache_resource
+def get_audit_writer():
+    return _AuditWriter()
+
+def _audit_ts(dt):
+    """時間點 -> audit 的 ts 字串；沒有時區的時間視為台北時間"""
+    tz = pytz.timezone('Asia/Taipei')
+    dt = tz.localize(dt) if dt.tzinfo is None else dt.astimezone(tz)
+    return dt.isoformat(timespec="microseconds")
+
+def log_mutation(helper, collection, doc_id, before, after, actor=None):
+    now = taipei_now()
+    get_audit_writer().put({
+        "id": f"{now.strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:8]}", "ts": _audit_ts(now), "actor": actor or _current_actor(), "tenant": current_tenant(),
+        "helper": helper, "target": f"{collection}/{doc_id}", "collection": collection, "doc_id": doc_id,
+        "before": _audit_encode(before), "after": _audit_encode(after),
+    })
+
+def compact_audit_log(cutoff=None):
+    """把 cutoff (時間點，預設保留天數之前) 之前的紀錄壓縮成每份文件一筆快照後刪除原紀錄；回傳刪除筆數"""
+    cutoff = _audit_ts(cutoff or taipei_now() - datetime.timedelta(days=AUDIT_RETENTION_DAYS))
+    latest, refs = {}, []
+    for doc in tenant_col("audit_log").where(filter=firestore.FieldFilter("ts", "<=", cutoff)).order_by("ts").stream():
+        e = doc.to_dict()
+        latest[e["target"]] = e
+        refs.append(doc.reference)
+    batch, n = db.batch(), 0
+    for target, e in latest.items():
+        # 快照時間取該文件最後一次異動的時間，在下一次異動之前都代表正確狀態
+        snap_id = f"{target.replace('/', '__')}@{e['ts']}"
+        batch.set(tenant_col("audit_snapshots").document(snap_id),
+                  {"target": target, "collection": e["collection"], "doc_id": e["doc_id"], "ts": e["ts"], "state": e["after"]})
+        n += 1
+        if n % 400 == 0: batch.commit(); batch = db.batch()
+    batch.commit()
+    for i in range(0, len(refs), 400):
+        batch = db.batch()
+        for ref in refs[i:i+400]: batch.delete(ref)
+        batch.commit()
+    tenant_col("settings").document("audit_meta").set({"compacted_at": _audit_ts(taipei_now()), "cutoff": cutoff}, merge=True)
+    return len(refs)
+
+def reconstruct_state(collection, doc_id, at):
+    """某份文件在時間點 at (沒有時區時視為台北時間) 的內容 (None 表示當時不存在)。
+    依序找：at 之前最後一筆異動 → at 之前最後一份快照 → at 之後第一筆異動的 before → 目前內容。
+    at 落在已壓縮的區間 (之前沒有快照、之後才有) 時丟出 ValueError。"""
+    target, at_s = f"{collection}/{doc_id}", _audit_ts(at)
+    by_target = firestore.FieldFilter("target", "==", target)
+    for doc in tenant_col("audit_log").where(filter=by_target).where(filter=firestore.FieldFilter("ts", "<=", at_s)).order_by("ts", direction=firestore.Query.DESCENDING).limit(1).stream():
+        return _audit_decode(doc.to_dict()["after"])
+    for doc in tenant_col("audit_snapshots").where(filter=by_target).where(filter=firestore.FieldFilter("ts", "<=", at_s)).order_by("ts", direction=firestore.Query.DESCENDING).limit(1).stream():
+        return _audit_decode(doc.to_dict()["state"])
+    # at 之後才有快照：at 到快照之間的異動已被壓縮刪除，無法得知 at 當時的內容
+    for doc in tenant_col("audit_snapshots").where(filter=by_target).where(filter=firestore.FieldFilter("ts", ">", at_s)).order_by("ts").limit(1).stream():
+        raise ValueError(f"{doc.to_dict()['ts'][:16]} 之前的異動紀錄已壓縮，無法還原到這個時間點")
+    for doc in tenant_col("audit_log").where(filter=by_target).where(filter=firestore.FieldFilter("ts", ">", at_s)).order_by("ts").limit(1).stream():
+        return _audit_decode(doc.to_dict()["before"])
+    doc = tenant_col(collection).document(doc_id).get()
+    return doc.to_dict() if doc.exists else None
+
+# --- 課程目錄：courses/<課程名稱> = {grade_band, default_teacher, location, weekly_slots} ---
+# 目錄依版本號快取 (settings/course_catalog_meta.version)，每次修改版本號 +1，
+# 同一版本只讀取、排序、建立前綴索引一次。
+DEFAULT_COURSES = ["小四數學", "小五數學", "小六數學", "國一數學", "國二數學", "國三數學", "國二理化", "國二自然", "高一數學", "高一物理", "高一化學"]
+GRADE_BANDS = ["小", "國", "高"]
+
+def _course_sort_key(x):
+    for i, prefix in enumerate(GRADE_BANDS):
+        if x.startswith(prefix): return (i, x)
+    return (99, x)
+
+def _seed_course_catalog():
+    """第一次使用時由預設課程與舊的 settings/courses 清單建立目錄"""
+    doc = tenant_col("settings").document("courses").get()
+    saved_list = doc.to_dict().get("list", []) if doc.exists else []
+    batch = db.batch()
+    for name in set(DEFAULT_COURSES + saved_list):
+        band = next((b for b in GRADE_BANDS if name.startswith(b)), "")
+        batch.set(tenant_col("courses").document(name), {"name": name, "grade_band": band, "default_teacher": "", "location": "", "weekly_slots": []})
+    batch.set(tenant_col("settings").document("course_catalog_meta"), {"version": 1})
+    batch.commit()
+
+@tenant_cache(st.cache_data(ttl=60))
+def get_course_catalog_version():
+    doc = tenant_col("settings").document("course_catalog_meta").get()
+    if not doc.exists:
+        _seed_course_catalog()
+        return 1
+    return doc.to_dict().get("version", 1)
+
+@tenant_cache(st.cache_data)
+def _load_course_catalog(version):
+    courses = {doc.id: {"name": doc.id, **doc.to_dict()} for doc in tenant_col("courses").stream()}
+    names = sorted(courses, key=_course_sort_key)
+    prefix_index = defaultdict(list)
+    for name in names:
+        for i in range(1, len(name) + 1): prefix_index[name[:i]].append(name)
+    return {"version": version, "courses": courses, "names": names, "prefix_index": dict(prefix_index)}
+
+def get_course_catalog():
+    return _load_course_catalog(get_course_catalog_version())
+
 def get_unique_course_names():
-    default_courses = ["小四數學", "小五數學", "小六數學", "國一數學", "國二數學", "國三數學", "國二理化", "國二自然", "高一數學", "高一物理", "高一化學"]
-    doc = db.collection("settings").document("courses").get()
-    if doc.exists:
-        saved_list = doc.to_dict().get("list", [])
-        combined = list(set(default_courses + saved_list))
-        def sort_key(x):
-            order = ["小", "國", "高"]
-            for i, prefix in enumerate(order):
-                if x.startswith(prefix): return (i, x)
-            return (99, x)
-        return sorted(combined, key=sort_key)
-    return default_courses
+    return get_course_catalog()["names"]
+
+def search_courses(prefix):
+    catalog = get_course_catalog()
+    return catalog["prefix_index"].get(prefix.strip(), []) if prefix.strip() else catalog["names"]
+
+def get_course_location(course_name, fallback=""):
+    """課程的上課地點以目錄為準，目錄沒有設定時才使用行程本身的 location"""
+    loc = get_course_catalog()["courses"].get(_course_key(course_name), {}).get("location") or fallback
+    return "櫃檯" if loc == "線上" else loc
+
+def save_course(course_name, **meta):
+    before = get_course_catalog()["courses"].get(course_name)
+    tenant_col("courses").document(course_name).set({"name": course_name, **meta}, merge=True)
+    log_mutation("save_course", "courses", course_name, before, {**(before or {}), "name": course_name, **meta})
+    tenant_col("settings").document("course_catalog_meta").set({"version": firestore.Increment(1)}, merge=True)
+    get_course_catalog_version.clear()
+    get_scheduler().invalidate("roll_call_plan")
+
+def delete_course(course_name):
+    before = get_course_catalog()["courses"].get(course_name)
+    tenant_col("courses").document(course_name).delete()
+    log_mutation("delete_course", "courses", course_name, before, None)
+    tenant_col("settings").document("course_catalog_meta").set({"version": firestore.Increment(1)}, merge=True)
+    get_course_catalog_version.clear()
+    get_scheduler().invalidate("roll_call_plan")
 
 def save_course_name(course_name):
-    current = get_unique_course_names()
-    if course_name not in current:
-        current.append(course_name)
-        db.collection("settings").document("courses").set({"list": current})
+    if course_name not in get_course_catalog()["courses"]:
+        band = next((b for b in GRADE_BANDS if course_name.startswith(b)), "")
+        save_course(course_name, grade_band=band, default_teacher="", location="", weekly_slots=[])
 
 def get_teachers_data():
-    docs = db.collection("teachers_config").stream()
+    docs = tenant_col("teachers_config").stream()
     return {doc.id: doc.to_dict() for doc in docs}
 
 def save_teacher_data(name, rate):
-    db.collection("teachers_config").document(name).set({"rate": rate})
+    before = tenant_col("teachers_config").document(name).get()
+    tenant_col("teachers_config").document(name).set({"rate": rate})
+    log_mutation("save_teacher_data", "teachers_config", name, before.to_dict() if before.exists else None, {"rate": rate})
     st.toast(f"已更新 {name} 的薪資設定")
 
-@st.cache_data(ttl=300)
+@tenant_cache(st.cache_data(ttl=300))
 def get_students_data_cached():
-    doc = db.collection("settings").document("students_detail").get()
-    return doc.to_dict().get("data", []) if doc.exists else []
-
-def save_students_data(new_data_list):
-    db.collection("settings").document("students_detail").set({"data": new_data_list})
+    def fetch():
+        doc = tenant_col("settings").document("students_detail").get()
+        return doc.to_dict().get("data", []) if doc.exists else []
+    return read_with_fallback("students", fetch)
+
+# --- 學生識別碼 ---
+# 每位學生有一個固定的 sid (uuid)，同一人報名多個班別時每列共用同一個 sid。
+# 點名紀錄、點名索引與試聽轉正都以 sid 為準，姓名只用於顯示。
+def new_student_id():
+    return uuid.uuid4().hex
+
+def _student_identity(s):
+    return (str(s.get('姓名') or '').strip(), str(s.get('年級') or '').strip(), str(s.get('學生手機') or '').strip())
+
+def find_student_id(students, name, grade, phone, fallback=None):
+    """名單中已有同姓名、年級、手機的學生就沿用其 sid (例如同一人加報其他班)；找不到時用 fallback 或配發新的 sid。
+    沒填手機時無法確認是同一人，一律不沿用 (同名同年級的不同學生不能共用 sid)"""
+    key = _student_identity({'姓名': name, '年級': grade, '學生手機': phone})
+    if not key[2]: return fallback or new_student_id()
+    for s in students:
+        if s.get('sid') and _student_identity(s) == key: return s['sid']
+    return fallback or new_student_id()
+
+def student_row_key(s):
+    """名單中的一列 (一位學生的一個班別)"""
+    return f"{s.get('sid')}|{s.get('班別')}"
+
+def get_student_names(students, labels=None):
+    """{sid: 顯示名稱}；同名不同人時加上年級，仍相同再加上手機末 3 碼，最後以 sid 前 4 碼區分。
+    已不在名單內的學生以點名紀錄中的 labels 補上"""
+    names = dict(labels or {})
+    grades, phones = {}, {}
+    for s in students:
+        if s.get('sid'):
+            names[s['sid']] = s.get('姓名', '')
+            grades[s['sid']] = s.get('年級', '')
+            phones[s['sid']] = re.sub(r'\D', '', str(s.get('學生手機') or ''))[-3:]
+    for suffix in (lambda sid: f" ({grades.get(sid) or sid[:4]})", lambda sid: f" #{phones[sid]}" if phones.get(sid) else "", lambda sid: f" [{sid[:4]}]"):
+        count = defaultdict(int)
+        for n in names.values(): count[n] += 1
+        names = {sid: (n + suffix(sid) if count[n] > 1 else n) for sid, n in names.items()}
+    return names
+
+def save_students_data(new_data_list, helper="save_students_data"):
+    before = get_students_data_cached()
+    tenant_col("settings").document("students_detail").set({"data": new_data_list})
+    log_mutation(helper, "settings", "students_detail", {"data": before}, {"data": new_data_list})
     get_students_data_cached.clear()
+    get_roster_frame_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
     st.toast("學生名單已更新")
 
-@st.cache_data(ttl=300)
+# --- 名單查詢 ---
+# 名單轉成一份型別固定的 DataFrame 後快取 (rerun 之間共用，呼叫端只能讀取不可修改)，
+# 篩選、排序與分頁都在這裡完成，畫面只拿到目前這一頁。
+ROSTER_COLUMNS = ["姓名", "狀態", "年級", "班別", "學生手機", "爸爸", "媽媽", "家裡"]
+
+@tenant_cache(st.cache_resource(ttl=300))
+def get_roster_frame_cached():
+    students = get_students_data_cached()
+    df = pd.DataFrame(students)
+    for c in ROSTER_COLUMNS + ["sid", "leaving_date", "joined_date"]:
+        if c not in df.columns: df[c] = ""
+    for c in ["refund_needed", "refund_settled"]:
+        if c not in df.columns: df[c] = False
+    text_cols = ["sid", "姓名", "學生手機", "爸爸", "媽媽", "家裡", "leaving_date", "joined_date"]
+    df[text_cols] = df[text_cols].fillna("").astype(str)
+    df["班別"] = df["班別"].fillna("").astype(str)
+    left = df["leaving_date"] != ""
+    df["狀態"] = "在班"
+    df.loc[left, "狀態"] = "離班 (" + df.loc[left, "leaving_date"] + ")"
+    df["_key"] = df["sid"] + "|" + df["班別"]
+    # 顯示名稱沿用 get_student_names，同名學生在選單中才分得出來
+    # 空名單時 map 會得到 float 欄位，先轉回字串再組合
+    df["_label"] = df["sid"].map(get_student_names(students)).fillna(df["姓名"]).astype(str) + " (" + df["班別"] + ")"
+    df.loc[left, "_label"] = df.loc[left, "_label"] + " [已設離班: " + df.loc[left, "leaving_date"] + "]"
+    # 搜尋用的小寫合併欄位，避免每次查詢重新組字串
+    df["_search"] = (df["姓名"] + " " + df["班別"] + " " + df["學生手機"]).str.lower()
+    grades = df["年級"].fillna("").astype(str)
+    df["年級"] = pd.Categorical(grades, categories=GRADE_OPTIONS + sorted(set(grades) - set(GRADE_OPTIONS)), ordered=True)
+    df["班別"] = pd.Categorical(df["班別"], categories=sorted(set(df["班別"]), key=_course_sort_key))
+    df["_left"] = left
+    df["_refund"] = df["refund_needed"].fillna(False).astype(bool) & ~df["refund_settled"].fillna(False).astype(bool)
+    out = df[ROSTER_COLUMNS + ["sid", "leaving_date", "joined_date", "_key", "_label", "_search", "_left", "_refund"]]
+    # 名單內容的雜湊當作資料版本，報表依版本快取
+    out.attrs["version"] = hashlib.sha1(json.dumps(students, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+    return out
+
+def get_roster_courses():
+    return [c for c in get_roster_frame_cached()["班別"].cat.categories if c]
+
+def query_roster(course="全部", search="", status="全部", sort_by="姓名", page=1, page_size=50):
+    """回傳 (該頁 DataFrame, 符合條件總筆數, 實際頁碼)"""
+    df = get_roster_frame_cached()
+    mask = pd.Series(True, index=df.index)
+    if course != "全部": mask &= df["班別"] == course
+    if status == "在班": mask &= ~df["_left"]
+    elif status == "離班": mask &= df["_left"]
+    if search.strip(): mask &= df["_search"].str.contains(search.strip().lower(), regex=False)
+    hits = df[mask]
+    total = len(hits)
+    pages = max(1, -(-total // page_size))
+    page = min(max(1, int(page)), pages)
+    if sort_by in hits.columns: hits = hits.sort_values([sort_by, "姓名"], kind="stable")
+    return hits.iloc[(page - 1) * page_size: page * page_size], total, page
+
+def get_roster_labels(keys):
+    df = get_roster_frame_cached()
+    hits = df[df["_key"].isin(keys)]
+    return dict(zip(hits["_key"], hits["_label"]))
+
+def roster_picker(label, key, multi=False, page_size=20):
+    """可搜尋、分頁的學生選擇器：只為目前頁面建立選項，已選取的項目跨頁保留"""
+    c1, c2 = st.columns([3, 1])
+    q = c1.text_input(f"搜尋{label}", key=f"{key}_q", placeholder="姓名 / 班別 / 手機")
+    page_no = c2.number_input("頁", min_value=1, value=1, step=1, key=f"{key}_page")
+    page_df, total, page_no = query_roster(search=q, page=page_no, page_size=page_size)
+    st.caption(f"符合 {total} 筆，第 {page_no} / {max(1, -(-total // page_size))} 頁")
+    labels = dict(zip(page_df["_key"], page_df["_label"]))
+    if multi:
+        chosen = st.session_state.get(key, [])
+        labels.update(get_roster_labels(chosen))
+        return st.multiselect(label, list(dict.fromkeys(chosen + list(labels))), format_func=lambda k: labels.get(k, k), key=key)
+    return st.selectbox(label, ["請選擇"] + list(labels), format_func=lambda k: labels.get(k, k), key=key)
+
+# --- 名單報表 ---
+# 報表依名單版本快取，名單沒變就不重算；分組、樞紐與每月統計都是向量化運算。
+# 匯出時 CSV 分批、Excel 以 openpyxl write-only 模式逐列寫入暫存檔，不建立整張工作表的儲存格物件。
+REPORT_MONTHS = 12
+REPORT_KINDS = {"class_list": "班級名單", "contacts": "聯絡簿", "refunds": "待退費名單", "summary": "統計報表"}
+CONTACT_COLUMNS = ["學生手機", "爸爸", "媽媽", "家裡"]
+
+@tenant_cache(st.cache_data(ttl=3600))
+def get_roster_reports(version, today):
+    """version 為名單版本、today 決定誰仍在班 (最後上課日在今天之後的學生仍算在班)"""
+    df = get_roster_frame_cached()
+    attending = df[(df["leaving_date"] == "") | (df["leaving_date"] >= today)]
+
+    # 班別 x 年級 的學生數；合計列以 sid 去重，同一位學生上多個班只算一次
+    counts = attending.groupby(["班別", "年級"], observed=True)["sid"].nunique().unstack("年級", fill_value=0)
+    counts.index, counts.columns = counts.index.astype(str), counts.columns.astype(str)
+    counts["合計"] = attending.groupby("班別", observed=True)["sid"].nunique().rename(index=str)
+    totals = attending.groupby("年級", observed=True)["sid"].nunique().rename(index=str)
+    counts.loc["合計"] = [*totals.reindex(counts.columns[:-1], fill_value=0), attending["sid"].nunique()]
+    by_course_grade = counts.rename_axis(index="班別", columns=None).reset_index()
+
+    # 每月新入班 / 離班 / 月底在班 (以班別人次計)；入班日期不明的視為早於統計區間
+    months = pd.period_range(end=pd.Period(today[:7], "M"), periods=REPORT_MONTHS, freq="M")
+    joined = pd.to_datetime(df["joined_date"].where(df["joined_date"] != ""), errors="coerce").dt.to_period("M")
+    left = pd.to_datetime(df["leaving_date"].where(df["leaving_date"] != ""), errors="coerce").dt.to_period("M")
+    new = joined.value_counts().reindex(months, fill_value=0)
+    gone = left.value_counts().reindex(months, fill_value=0)
+    start = int((joined.isna() | (joined < months[0])).sum() - (left < months[0]).sum())
+    monthly = pd.DataFrame({"月份": months.astype(str), "新入班": new.values, "離班": gone.values,
+                            "月底在班": start + new.cumsum().values - gone.cumsum().values})
+
+    refunds = df[df["_refund"]].sort_values(["leaving_date", "姓名"])
+    refunds = refunds[["sid", "姓名", "年級", "班別", "leaving_date"] + CONTACT_COLUMNS].rename(columns={"leaving_date": "最後上課日"})
+
+    ordered = attending.sort_values(["班別", "年級", "姓名"])
+    class_list = ordered[["班別", "姓名", "年級", "學生手機", "狀態"]]
+    contacts = ordered.groupby("sid", sort=False, observed=True).agg(
+        姓名=("姓名", "first"), 年級=("年級", "first"), 班別=("班別", lambda c: "、".join(map(str, c))),
+        **{c: (c, "first") for c in CONTACT_COLUMNS}).sort_values(["年級", "姓名"]).reset_index(drop=True)
+    return {"by_course_grade": by_course_grade, "monthly": monthly, "refunds": refunds.reset_index(drop=True),
+            "class_list": class_list.reset_index(drop=True), "contacts": contacts}
+
+def get_current_roster_reports():
+    return get_roster_reports(get_roster_frame_cached().attrs["version"], datetime.date.today().isoformat())
+
+def _sheet_title(name):
+    return re.sub(r"[\[\]:*?/\\]", "_", str(name))[:31] or "Sheet"
+
+def _excel_value(v):
+    if v is None or (not isinstance(v, str) and pd.isna(v)): return None
+    return v if isinstance(v, (str, int, float, bool)) else (v.item() if hasattr(v, "item") else str(v))
+
+def export_roster_report(kind, fmt="xlsx", tenant=None):
+    """產生報表檔內容 (bytes)。tenant 由畫面傳入：下載按鈕的產生函式在另一個執行緒執行。
+    CSV 分批寫入、Excel 以 write-only 模式逐列寫入暫存檔，產生過程不在記憶體中組出整份內容；
+    下載按鈕只接受完整的 bytes，所以完成的檔案最後仍會整份讀進記憶體。"""
+    with tenant_scope(tenant or current_tenant()): reports = get_current_roster_reports()
+    if kind == "summary": sheets = [("班別x年級", reports["by_course_grade"]), ("每月異動", reports["monthly"])]
+    elif kind == "class_list": sheets = [(c, g.drop(columns="班別")) for c, g in reports["class_list"].groupby("班別", sort=False, observed=True)]
+    else: sheets = [(REPORT_KINDS[kind], reports[kind].drop(columns="sid", errors="ignore"))]
+
+    with tempfile.TemporaryFile() as out:
+        if fmt == "csv":
+            frame = reports["class_list"] if kind == "class_list" else sheets[0][1]
+            text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+            frame.to_csv(text, index=False, chunksize=5000)
+            text.flush()
+            text.detach()
+        else:
+            import openpyxl
+            wb = openpyxl.Workbook(write_only=True)
+            for title, frame in sheets or [(REPORT_KINDS[kind], pd.DataFrame())]:
+                ws = wb.create_sheet(_sheet_title(title))
+                ws.append([str(c) for c in frame.columns])
+                for row in frame.itertuples(index=False, name=None): ws.append([_excel_value(v) for v in row])
+            wb.save(out)
+        out.seek(0)
+        return out.read()
+
+def settle_refunds(sids):
+    """把選取學生的退費標記為已結算"""
+    sids, today = set(sids), datetime.date.today().isoformat()
+    students = [{**s, "refund_settled": today} if s.get("sid") in sids and s.get("refund_needed") and not s.get("refund_settled") else s
+                for s in get_students_data_cached()]
+    save_students_data(students, helper="settle_refunds")
+
+@tenant_cache(st.cache_data(ttl=300))
 def get_part_timers_list_cached():
-    doc = db.collection("settings").document("part_timers").get()
+    doc = tenant_col("settings").document("part_timers").get()
     return doc.to_dict().get("list", ["工讀生A", "工讀生B"]) if doc.exists else ["工讀生A", "工讀生B"]
 
 def save_part_timers_list(new_list):
-    db.collection("settings").document("part_timers").set({"list": new_list})
+    before = get_part_timers_list_cached()
+    tenant_col("settings").document("part_timers").set({"list": new_list})
+    log_mutation("save_part_timers_list", "settings", "part_timers", {"list": before}, {"list": new_list})
     get_part_timers_list_cached.clear()
     st.toast("工讀生名單已更新")
 
 # --- 假期管理 ---
 def get_teacher_vacations():
-    docs = db.collection("teacher_vacations").stream()
+    docs = tenant_col("teacher_vacations").stream()
     return [{**doc.to_dict(), "id": doc.id} for doc in docs]
 
 def save_teacher_vacation(teacher, start, end, reason):
-    db.collection("teacher_vacations").add({
-        "teacher": teacher, "start": start.isoformat(), "end": end.isoformat(), "reason": reason, "created_at": datetime.datetime.now().isoformat()
-    })
+    data = {"teacher": teacher, "start": start.isoformat(), "end": end.isoformat(), "reason": reason, "created_at": datetime.datetime.now().isoformat()}
+    _, ref = tenant_col("teacher_vacations").add(data)
+    log_mutation("save_teacher_vacation", "teacher_vacations", ref.id, None, data)
     get_teacher_vacations_cached.clear() 
 
 def delete_teacher_vacation(doc_id):
-    db.collection("teacher_vacations").document(doc_id).delete()
+    before = next((v for v in get_teacher_vacations_cached() if v["id"] == doc_id), None)
+    tenant_col("teacher_vacations").document(doc_id).delete()
+    log_mutation("delete_teacher_vacation", "teacher_vacations", doc_id, before, None)
     get_teacher_vacations_cached.clear()
 
-@st.cache_data(ttl=300)
+@tenant_cache(st.cache_data(ttl=300))
 def get_teacher_vacations_cached():
     return get_teacher_vacations()
 
 # --- 試聽生與潛在名單管理 ---
 def get_trial_students():
-    docs = db.collection("trial_students").stream()
+    docs = tenant_col("trial_students").stream()
     return [{**doc.to_dict(), "id": doc.id} for doc in docs]
 
 def save_trial_student(data):
-    db.collection("trial_students").add(data)
+    data = {"sid": new_student_id(), **data}
+    _, ref = tenant_col("trial_students").add(data)
+    log_mutation("save_trial_student", "trial_students", ref.id, None, data)
+    get_scheduler().invalidate("trial_follow_ups")
     st.toast("已新增試聽生")
 
-def delete_trial_student(doc_id):
-    db.collection("trial_students").document(doc_id).delete()
+def delete_trial_student(doc_id, before=None, helper="delete_trial_student"):
+    tenant_col("trial_students").document(doc_id).delete()
+    log_mutation(helper, "trial_students", doc_id, before, None)
+    get_scheduler().invalidate("trial_follow_ups")
 
 def get_potential_students():
-    docs = db.collection("potential_students").order_by("archived_at", direction=firestore.Query.DESCENDING).limit(100).stream()
+    docs = tenant_col("potential_students").order_by("archived_at", direction=firestore.Query.DESCENDING).limit(100).stream()
     return [{**doc.to_dict(), "id": doc.id} for doc in docs]
 
 def move_trial_to_official(trial_data, doc_id):
     current_students = get_students_data_cached()
     new_student = {
+        # 已在名單中的學生 (試聽第二個班) 沿用原本的 sid，出缺勤紀錄才不會分散
+        "sid": find_student_id(current_students, trial_data.get("name"), trial_data.get("grade"), trial_data.get("stu_mob", ""), fallback=trial_data.get("sid")),
         "姓名": trial_data.get("name"),
         "年級": trial_data.get("grade"),
         "班別": trial_data.get("course"),
@@ -157,11 +645,12 @@ def move_trial_to_official(trial_data, doc_id):
         "家裡": trial_data.get("home_tel", ""),
         "爸爸": trial_data.get("dad_tel", ""),
         "媽媽": trial_data.get("mom_tel", ""),
-        "其他家人": trial_data.get("other_tel", "")
+        "其他家人": trial_data.get("other_tel", ""),
+        "joined_date": datetime.date.today().isoformat()
     }
     current_students.append(new_student)
-    save_students_data(current_students)
-    delete_trial_student(doc_id)
+    save_students_data(current_students, helper="move_trial_to_official")
+    delete_trial_student(doc_id, before=trial_data, helper="move_trial_to_official")
     st.success(f"🎉 歡迎 {trial_data.get('name')} 加入 {trial_data.get('course')}！資料已自動轉入。")
     time.sleep(1.5)
     st.rerun()
@@ -170,105 +659,1080 @@ def move_trial_to_potential(trial_data, doc_id):
     archive_data = trial_data.copy()
     archive_data['archived_at'] = datetime.datetime.now().isoformat()
     archive_data['status'] = 'did_not_join'
-    db.collection("potential_students").add(archive_data)
-    delete_trial_student(doc_id)
+    _, ref = tenant_col("potential_students").add(archive_data)
+    log_mutation("move_trial_to_potential", "potential_students", ref.id, None, archive_data)
+    delete_trial_student(doc_id, before=trial_data, helper="move_trial_to_potential")
     st.info(f"📂 已將 {trial_data.get('name')} 歸檔至潛在名單")
     time.sleep(1.5)
     st.rerun()
 
 # --- 點名與活動 ---
 def get_roll_call_from_db(date_str):
-    doc = db.collection("roll_call_records").document(date_str).get()
-    return doc.to_dict() if doc.exists else None
-
-def get_all_roll_calls():
-    docs = db.collection("roll_call_records").stream()
+    def fetch():
+        doc = tenant_col("roll_call_records").document(date_str).get()
+        if doc.exists: return doc.to_dict()
+        for term in archived_terms_between("roll_call_records", date_str, date_str):
+            return get_archived_term("roll_call_records", term).get(date_str)
+        return None
+    return read_with_fallback(f"roll_call/{date_str}", fetch)
+
+def get_all_roll_calls(include_archive=False):
+    """目前 (未封存) 的所有點名紀錄；include_archive 時連同已封存學期一起讀取"""
+    docs = tenant_col("roll_call_records").stream()
+    records = {doc.id: doc.to_dict() for doc in docs}
+    if not include_archive: return records
+    archived = {}
+    for term in get_archive_meta_cached().get("terms", {}).get("roll_call_records", {}): archived.update(get_archived_term("roll_call_records", term))
+    return {**archived, **records}
+
+def _query_roll_calls(start_key, end_key):
+    """以文件 ID (日期字串) 範圍查詢，只讀取區間內 (未封存) 的點名紀錄"""
+    col = tenant_col("roll_call_records")
+    docs = col.where(filter=firestore.FieldFilter("__name__", ">=", col.document(start_key))).where(filter=firestore.FieldFilter("__name__", "<=", col.document(end_key))).stream()
     return {doc.id: doc.to_dict() for doc in docs}
 
-def save_roll_call_to_db(date_str, data):
-    db.collection("roll_call_records").document(date_str).set(data)
+def get_roll_calls_between(start_key, end_key):
+    """區間內的點名紀錄；區間涵蓋已封存的學期時才讀取封存資料"""
+    records = _query_roll_calls(start_key, end_key)
+    for term in archived_terms_between("roll_call_records", start_key, end_key):
+        for date_str, rec in get_archived_term("roll_call_records", term).items():
+            if start_key <= date_str <= end_key: records.setdefault(date_str, rec)
+    return records
+
+# --- 點名索引：roll_call_index/<sid> = {"name": 姓名, "present": [日期...], "leave": [...], "absent": [...]} ---
+# 每次儲存點名時在同一個 transaction 內更新，查詢單一學生的出缺勤只需讀一份文件。
+ROLL_CALL_STATUSES = ["present", "leave", "absent"]
+
+def _roll_call_status_map(record):
+    """點名紀錄 -> {sid: 狀態}；同一人出現在多個清單時以 到 > 假 > 未到 為準"""
+    status_map = {}
+    for status in reversed(ROLL_CALL_STATUSES):
+        for student in (record or {}).get(status, []): status_map[student] = status
+    return status_map
+
+def _index_update_for(date_str, new_status):
+    return {s: (firestore.ArrayUnion([date_str]) if s == new_status else firestore.ArrayRemove([date_str])) for s in ROLL_CALL_STATUSES}
+
+def merge_roll_call(base, local, server):
+    """離線期間其他裝置也改過同一天的點名：本機改過的學生用本機狀態，其餘學生保留伺服器上的狀態"""
+    if not server or (base or {}).get("updated_at") == server.get("updated_at"): return local
+    base_map, local_map, merged = _roll_call_status_map(base), _roll_call_status_map(local), _roll_call_status_map(server)
+    for sid in set(base_map) | set(local_map):
+        if base_map.get(sid) == local_map.get(sid): continue
+        if local_map.get(sid): merged[sid] = local_map[sid]
+        else: merged.pop(sid, None)
+    labels = {**server.get("labels", {}), **local.get("labels", {})}
+    out = {**local, "labels": {sid: labels.get(sid, "") for sid in merged}}
+    for status in ROLL_CALL_STATUSES: out[status] = [sid for sid, s in merged.items() if s == status]
+    return out
+
+def save_roll_call_to_db(date_str, data, base=None, write_id=None, actor=None):
+    """write_id 由離線寫入佇列傳入：同一個 write_id 只會寫入一次，伺服器紀錄在 base 之後被改過時與本機異動合併"""
+    ref = tenant_col("roll_call_records").document(date_str)
+    before, after = {}, {}
+
+    @firestore.transactional
+    def _save(transaction):
+        snap = ref.get(transaction=transaction)
+        before["data"] = snap.to_dict() if snap.exists else None
+        after["data"] = None
+        if write_id and (before["data"] or {}).get("write_id") == write_id: return
+        new = {**merge_roll_call(base, data, before["data"]), "write_id": write_id} if write_id else data
+        old_map = _roll_call_status_map(before["data"])
+        new_map = _roll_call_status_map(new)
+        labels = new.get("labels", {})
+        transaction.set(ref, new)
+        for sid in set(old_map) | set(new_map):
+            if old_map.get(sid) == new_map.get(sid): continue
+            update = _index_update_for(date_str, new_map.get(sid))
+            if labels.get(sid): update["name"] = labels[sid]
+            transaction.set(tenant_col("roll_call_index").document(sid), update, merge=True)
+        after["data"] = new
+
+    _save(db.transaction())
+    if after["data"] is not None:
+        log_mutation("save_roll_call_to_db", "roll_call_records", date_str, before["data"], after["data"], actor=actor)
+
+def backfill_roll_call_index():
+    """從所有 roll_call_records 重建 roll_call_index (只需執行一次)"""
+    index = defaultdict(lambda: {s: [] for s in ROLL_CALL_STATUSES})
+    names = {}
+    for date_str, rec in sorted(get_all_roll_calls(include_archive=True).items()):
+        names.update(rec.get("labels", {}))
+        for sid, status in _roll_call_status_map(rec).items(): index[sid][status].append(date_str)
+    items = list(index.items())
+    for i in range(0, len(items), 400):
+        batch = db.batch()
+        for sid, dates in items[i:i+400]:
+            batch.set(tenant_col("roll_call_index").document(sid), {"name": names.get(sid, ""), **{s: sorted(v) for s, v in dates.items()}})
+        batch.commit()
+    tenant_col("settings").document("roll_call_index_meta").set({"backfilled_at": datetime.datetime.now().isoformat(), "students": len(items)})
+    return len(items)
+
+@tenant_cache(st.cache_resource)
+def ensure_roll_call_index():
+    """每個伺服器程序只檢查一次；尚未建立過索引就從歷史紀錄回填。
+    斷線時若本機記得之前已檢查過就直接略過"""
+    def check():
+        ensure_student_ids()
+        if not tenant_col("settings").document("roll_call_index_meta").get().exists: backfill_roll_call_index()
+        return True
+    return read_with_fallback("ensured/roll_call_index", check)
+
+def migrate_student_ids():
+    """一次性遷移：名單補上 sid，歷史點名紀錄由姓名改存 sid，並以 sid 重建點名索引。
+    舊紀錄中同名的學生無法區分，一律對應到名單中第一位；已不在名單中的姓名會配發新的 sid 並保留在 labels。"""
+    students = get_students_data_cached()
+    by_identity = {}
+    for s in students:
+        if not s.get('sid'): s['sid'] = by_identity.setdefault(_student_identity(s), new_student_id())
+        else: by_identity.setdefault(_student_identity(s), s['sid'])
+    log_mutation("migrate_student_ids", "settings", "students_detail", {"data": get_students_data_cached()}, {"data": students})
+    tenant_col("settings").document("students_detail").set({"data": students})
+    get_students_data_cached.clear()
+    get_roster_frame_cached.clear()
+
+    name_to_sid = {}
+    for s in students: name_to_sid.setdefault(s.get('姓名'), s['sid'])
+    batch, n = db.batch(), 0
+    for date_str, rec in get_all_roll_calls().items():
+        if rec.get("schema") == 2: continue
+        labels = {}
+        for status in ROLL_CALL_STATUSES:
+            sids = [name_to_sid.setdefault(name, new_student_id()) for name in rec.get(status, [])]
+            for name, sid in zip(rec.get(status, []), sids): labels[sid] = name
+            rec[status] = list(dict.fromkeys(sids))
+        rec["labels"] = labels
+        rec["schema"] = 2
+        batch.set(tenant_col("roll_call_records").document(date_str), rec); n += 1
+        if n % 400 == 0: batch.commit(); batch = db.batch()
+    batch.commit()
 
-@st.cache_data(ttl=600)
+    for t in get_trial_students():
+        if not t.get("sid"): tenant_col("trial_students").document(t["id"]).update({"sid": new_student_id()})
+
+    # 舊索引以姓名為文件 ID，全部刪除後以 sid 重建
+    for ref in tenant_col("roll_call_index").list_documents(): ref.delete()
+    backfill_roll_call_index()
+    tenant_col("settings").document("student_id_meta").set({"migrated_at": datetime.datetime.now().isoformat(), "roll_calls": n})
+
+@tenant_cache(st.cache_resource)
+def ensure_student_ids():
+    def check():
+        if not tenant_col("settings").document("student_id_meta").get().exists: migrate_student_ids()
+        return True
+    return read_with_fallback("ensured/student_ids", check)
+
+def get_student_attendance(sid):
+    doc = tenant_col("roll_call_index").document(sid).get()
+    data = doc.to_dict() if doc.exists else {}
+    return {s: sorted(data.get(s, [])) for s in ROLL_CALL_STATUSES}
+
+def get_term_range(d):
+    """學期區間：8/1 ~ 1/31 為上學期，2/1 ~ 7/31 為下學期"""
+    if d.month >= 8: return datetime.date(d.year, 8, 1), datetime.date(d.year + 1, 1, 31), f"{d.year - 1911} 上學期"
+    if d.month == 1: return datetime.date(d.year - 1, 8, 1), datetime.date(d.year, 1, 31), f"{d.year - 1912} 上學期"
+    return datetime.date(d.year, 2, 1), datetime.date(d.year, 7, 31), f"{d.year - 1912} 下學期"
+
+def build_term_attendance_report(start, end):
+    """一次掃過 roll_call_index，產生所有學生在區間內的出缺勤統計"""
+    s_str, e_str = start.isoformat(), end.isoformat()
+    students = get_students_data_cached()
+    names = get_student_names(students)
+    courses = defaultdict(list)
+    for s in students:
+        if s.get('班別') and s['班別'] not in courses[s.get('sid')]: courses[s.get('sid')].append(s['班別'])
+    rows = []
+    for doc in tenant_col("roll_call_index").stream():
+        data = doc.to_dict()
+        name = names.get(doc.id) or data.get("name") or doc.id
+        cnt = {status: sum(1 for d in data.get(status, []) if s_str <= d <= e_str) for status in ROLL_CALL_STATUSES}
+        total = sum(cnt.values())
+        if not total: continue
+        rows.append({"姓名": name, "班別": "、".join(courses.get(doc.id, [])), "出席": cnt["present"], "請假": cnt["leave"], "未到": cnt["absent"],
+                     "出席率": f"{cnt['present'] / total:.0%}"})
+    return pd.DataFrame(rows, columns=["姓名", "班別", "出席", "請假", "未到", "出席率"]).sort_values("姓名")
+
+def _shift_event(doc_id, data):
+    """shifts 文件 -> 行事曆事件 (公告回傳 None)"""
+    title = data.get("title", "")
+    color = "#3788d8"
+    if data.get("type") == "shift":
+        title = f"{data.get('title')} ({data.get('teacher')})"
+        color = "#28a745"
+        if "⚠️ 調課" in title: color = "#FF0000"
+    elif data.get("type") == "part_time":
+        title = f"{data.get('staff')}"
+        color = "#6f42c1"
+    elif data.get("type") == "notice":
+        return None  # 公告已移至 announcements，由 get_notice_badge_events 顯示
+
+    sanitized = {k: str(v) if isinstance(v, (datetime.date, datetime.datetime)) else v for k, v in data.items()}
+    return {"id": doc_id, "title": title, "start": data.get("start"), "end": data.get("end"), "color": color, "allDay": False, "extendedProps": sanitized}
+
+@tenant_cache(st.cache_data(ttl=600))
 def get_all_events_cached():
+    """目前 (未封存) 的行程與今年假日"""
     events = []
     try:
-        docs = db.collection("shifts").stream()
-        for doc in docs:
-            data = doc.to_dict()
-            title = data.get("title", "")
-            color = "#3788d8"
-            if data.get("type") == "shift":
-                title = f"{data.get('title')} ({data.get('teacher')})"
-                color = "#28a745"
-                if "⚠️ 調課" in title: color = "#FF0000"
-            elif data.get("type") == "part_time":
-                title = f"{data.get('staff')}"
-                color = "#6f42c1"
-            elif data.get("type") == "notice":
-                cat = data.get("category", "其他")
-                title = f"[{cat}] {title}"
-                color = {"調課": "#d63384", "考試": "#dc3545", "活動": "#0d6efd", "任務": "#FF4500"}.get(cat, "#ffc107")
-                if cat == "任務": title = f"🔥 {title}"
-            
-            sanitized = {k: str(v) if isinstance(v, (datetime.date, datetime.datetime)) else v for k, v in data.items()}
-            events.append({"id": doc.id, "title": title, "start": data.get("start"), "end": data.get("end"), "color": color, "allDay": data.get("type")=="notice", "extendedProps": sanitized})
+        shifts = read_with_fallback("shifts", lambda: {doc.id: doc.to_dict() for doc in tenant_col("shifts").stream()})
+        for doc_id, data in shifts.items():
+            event = _shift_event(doc_id, data)
+            if event: events.append(event)
     except: pass
     
+    for d in get_holidays_cached(datetime.date.today().year):
+        events.append({"id": f"hol_{d['date']}", "title": f"🌴 {d['description']}", "start": d['date'], "allDay": True, "display": "background", "backgroundColor": "#ffebee", "editable": False, "extendedProps": {"type": "holiday"}})
+    return events
+
+@st.cache_data(ttl=3600)
+def get_holidays_cached(year):
     try:
-        resp = requests.get(f"https://cdn.jsdelivr.net/gh/ruyut/TaiwanCalendar/data/{datetime.date.today().year}.json").json()
-        for d in resp:
-            if d.get('isHoliday'):
-                events.append({"id": f"hol_{d['date']}", "title": f"🌴 {d['description']}", "start": d['date'], "allDay": True, "display": "background", "backgroundColor": "#ffebee", "editable": False, "extendedProps": {"type": "holiday"}})
-    except: pass
+        resp = requests.get(f"https://cdn.jsdelivr.net/gh/ruyut/TaiwanCalendar/data/{year}.json").json()
+        return [{"date": d['date'], "description": d['description']} for d in resp if d.get('isHoliday')]
+    except: return []
+
+# --- 舊學期封存 ---
+# shifts / roll_call_records 只保留最近幾個學期；較舊的學期壓縮成 archives/<集合>_<學期>_<n> 後刪除原文件，
+# 日常讀取只需處理目前的資料。月統計與點名索引保留不動，查詢日期範圍涵蓋封存學期時才讀取封存資料。
+ARCHIVE_KEEP_TERMS = 2  # 保留本學期與上一學期，可用分校設定 archive_keep_terms 覆蓋
+ARCHIVE_KINDS = ["shifts", "roll_call_records"]
+ARCHIVE_PART_RECORDS = 500  # 每份封存文件的筆數上限，壓縮後遠低於 Firestore 1MB 限制
+
+def term_key(d):
+    """學期代號：學期開始的年月，例如 2025-08"""
+    return get_term_range(d)[0].strftime("%Y-%m")
+
+def archive_cutoff(today=None):
+    """封存分界日：這天之前開始的學期都可以封存"""
+    start = get_term_range(today or datetime.date.today())[0]
+    for _ in range(int(tenant_config("archive_keep_terms", ARCHIVE_KEEP_TERMS)) - 1):
+        start = get_term_range(start - datetime.timedelta(days=1))[0]
+    return start
+
+def _archive_date(kind, doc_id, data):
+    return (data.get("start") or "")[:10] if kind == "shifts" else doc_id
+
+@tenant_cache(st.cache_data(ttl=600))
+def get_archive_meta_cached():
+    """settings/archive_meta = {"cutoff": 日期, "terms": {集合: {學期: {start, end, count, parts}}}}"""
+    doc = tenant_col("settings").document("archive_meta").get()
+    return doc.to_dict() if doc.exists else {"terms": {}}
+
+def _read_archive(kind, term, parts):
+    records = {}
+    refs = [tenant_col("archives").document(f"{kind}_{term}_{i}") for i in range(parts)]
+    for snap in db.get_all(refs):
+        if snap.exists: records.update(json.loads(zlib.decompress(snap.to_dict()["data"]).decode("utf-8")))
+    return records
+
+@tenant_cache(st.cache_data(ttl=3600))
+def get_archived_term(kind, term):
+    """某個封存學期的資料 {文件 ID: 內容}"""
+    meta = get_archive_meta_cached().get("terms", {}).get(kind, {}).get(term)
+    return _read_archive(kind, term, meta["parts"]) if meta else {}
+
+def archived_terms_between(kind, start_key, end_key):
+    """與日期區間重疊的封存學期 (沒有封存資料時不需任何讀取)"""
+    terms = get_archive_meta_cached().get("terms", {}).get(kind, {})
+    return [t for t, m in sorted(terms.items()) if m["start"] <= end_key[:10] and start_key[:10] <= m["end"]]
+
+def get_archived_events(start_key, end_key):
+    events = []
+    for term in archived_terms_between("shifts", start_key, end_key):
+        for doc_id, data in get_archived_term("shifts", term).items():
+            if not (start_key <= (data.get("start") or "")[:10] <= end_key): continue
+            event = _shift_event(doc_id, data)
+            if event:
+                event["editable"] = False
+                event["extendedProps"]["archived"] = True
+                events.append(event)
     return events
 
+def get_events_between(start_key, end_key):
+    """日期區間內的行程；區間涵蓋已封存的學期時才讀取封存資料"""
+    events = [e for e in get_all_events_cached() if start_key <= (e.get("start") or "")[:10] <= end_key]
+    hot_ids = {e["id"] for e in events}
+    return events + [e for e in get_archived_events(start_key, end_key) if e["id"] not in hot_ids]
+
+def archive_old_terms(cutoff=None):
+    """把 cutoff 之前的學期封存並刪除原文件；回傳 {集合: 封存筆數}。
+    封存文件寫好後才刪除原文件，中途失敗重跑會再合併一次，不會遺失資料。"""
+    cutoff = cutoff or archive_cutoff()
+    cutoff_key = cutoff.isoformat()
+    hot = {
+        "shifts": {doc.id: doc.to_dict() for doc in tenant_col("shifts").where(filter=firestore.FieldFilter("start", "<", cutoff_key)).stream()},
+        "roll_call_records": _query_roll_calls("0000-00-00", (cutoff - datetime.timedelta(days=1)).isoformat()),
+    }
+    if not any(hot.values()): return {kind: 0 for kind in ARCHIVE_KINDS}
+
+    # 封存前補齊月統計，之後統計數字仍可直接讀取
+    months = {_archive_date(kind, doc_id, data)[:7] for kind, records in hot.items() for doc_id, data in records.items()}
+    for month in sorted(m for m in months if m):
+        if not tenant_col("aggregates").document(month).get().exists: compute_monthly_aggregates(month)
+
+    meta_ref = tenant_col("settings").document("archive_meta")
+    meta_doc = meta_ref.get()
+    meta = meta_doc.to_dict() if meta_doc.exists else {"terms": {}}
+    counts = {}
+    for kind, records in hot.items():
+        by_term = defaultdict(dict)
+        for doc_id, data in records.items():
+            try: by_term[term_key(datetime.date.fromisoformat(_archive_date(kind, doc_id, data)))][doc_id] = data
+            except ValueError: pass  # 日期格式錯誤的文件留在原處
+        for term, term_records in sorted(by_term.items()):
+            term_meta = meta["terms"].setdefault(kind, {}).get(term)
+            merged = {**(_read_archive(kind, term, term_meta["parts"]) if term_meta else {}), **term_records}
+            items = sorted(merged.items())
+            parts = [dict(items[i:i+ARCHIVE_PART_RECORDS]) for i in range(0, len(items), ARCHIVE_PART_RECORDS)]
+            batch = db.batch()
+            for i, part in enumerate(parts):
+                batch.set(tenant_col("archives").document(f"{kind}_{term}_{i}"), {
+                    "kind": kind, "term": term, "part": i, "count": len(part),
+                    "data": zlib.compress(json.dumps(part, ensure_ascii=False, default=str).encode("utf-8"))})
+            batch.commit()
+            t_start, t_end, _ = get_term_range(datetime.date.fromisoformat(f"{term}-01"))
+            meta["terms"][kind][term] = {"start": t_start.isoformat(), "end": t_end.isoformat(), "count": len(merged),
+                                         "parts": len(parts), "archived_at": datetime.datetime.now().isoformat()}
+            meta_ref.set({**meta, "cutoff": cutoff_key})
+            ids = list(term_records)
+            for i in range(0, len(ids), 400):
+                batch = db.batch()
+                for doc_id in ids[i:i+400]: batch.delete(tenant_col(kind).document(doc_id))
+                batch.commit()
+            log_mutation("archive_old_terms", "archives", f"{kind}_{term}", None, {"archived": len(ids), "total": len(merged)})
+        counts[kind] = sum(len(r) for r in by_term.values())
+
+    get_archive_meta_cached.clear()
+    get_archived_term.clear()
+    get_all_events_cached.clear()
+    # 封存的行程從訂閱檔移除
+    try: export_static_feeds()
+    except Exception as e: logger.warning("static export after archiving failed: %s", e)
+    return counts
+
 def add_event_to_db(title, start, end, type, user, location="", teacher_name="", category="", staff=""):
-    db.collection("shifts").add({
+    data = {
         "title": title, "start": start.isoformat(), "end": end.isoformat(), "type": type, "staff": staff if staff else user,
         "location": location, "teacher": teacher_name, "category": category, "created_at": datetime.datetime.now()
-    })
+    }
+    _, ref = tenant_col("shifts").add(data)
+    log_mutation("add_event_to_db", "shifts", ref.id, None, data)
     get_all_events_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
+    refresh_static_exports(_shift_feed_keys(data))
 
 def update_event_in_db(doc_id, update_dict):
-    db.collection("shifts").document(doc_id).update(update_dict)
+    before = _find_cached_shift(doc_id)
+    tenant_col("shifts").document(doc_id).update(update_dict)
+    log_mutation("update_event_in_db", "shifts", doc_id, before, {**(before or {}), **update_dict})
     get_all_events_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
+    refresh_static_exports(_shift_feed_keys(before) | _shift_feed_keys({**(before or {}), **update_dict}))
     st.toast("更新成功！")
 
 def delete_event_from_db(doc_id):
-    db.collection("shifts").document(doc_id).delete()
+    before = _find_cached_shift(doc_id)
+    tenant_col("shifts").document(doc_id).delete()
+    log_mutation("delete_event_from_db", "shifts", doc_id, before, None)
     get_all_events_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
+    refresh_static_exports(_shift_feed_keys(before))
     st.toast("刪除成功！")
 
 def batch_delete_events(doc_ids):
+    befores = {doc_id: _find_cached_shift(doc_id) for doc_id in doc_ids}
+    keys = set()
+    for before in befores.values(): keys |= _shift_feed_keys(before)
     batch = db.batch()
-    for doc_id in doc_ids: batch.delete(db.collection("shifts").document(doc_id))
+    for doc_id in doc_ids: batch.delete(tenant_col("shifts").document(doc_id))
     batch.commit()
+    for doc_id, before in befores.items(): log_mutation("batch_delete_events", "shifts", doc_id, before, None)
     get_all_events_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
+    refresh_static_exports(keys)
     st.toast(f"刪除 {len(doc_ids)} 筆")
 
 def batch_mark_reschedule(doc_ids):
-    batch = db.batch()
+    keys = set()
+    for doc_id in doc_ids: keys |= _shift_feed_keys(_find_cached_shift(doc_id))
+    batch, changes = db.batch(), []
     for doc_id in doc_ids:
-        ref = db.collection("shifts").document(doc_id)
+        ref = tenant_col("shifts").document(doc_id)
         curr = ref.get().to_dict()
         title = curr.get('title', '')
         if "⚠️ 調課" not in title:
             new_title = f"⚠️ 調課-{title}"
             batch.update(ref, {"title": new_title})
+            changes.append((doc_id, curr, {**curr, "title": new_title}))
     batch.commit()
+    for doc_id, before, after in changes: log_mutation("batch_mark_reschedule", "shifts", doc_id, before, after)
     get_all_events_cached.clear()
+    get_scheduler().invalidate("roll_call_plan")
+    refresh_static_exports(keys)
     st.toast(f"已將 {len(doc_ids)} 堂課標記為需調課", icon="⚠️")
 
+# --- 靜態班表匯出 (ICS / JSON) ---
+# 每位老師、每個課程、每個地點各一份 .ics 與 .json，外加 manifest.json 記錄每個檔案的內容雜湊 (etag)。
+# 只有內容雜湊改變時才會覆寫檔案，因此檔案的 mtime / 伺服器 ETag 保持穩定，客戶端可略過未變更的下載。
+EXPORT_KINDS = ["teacher", "course", "location"]
+
+def _course_key(title):
+    return (title or "").replace("⚠️ 調課-", "").strip()
+
+def _shift_feed_keys(props):
+    """一筆課程會出現在哪些匯出檔：{(kind, name), ...}"""
+    if not props or props.get("type") != "shift": return set()
+    keys = set()
+    if props.get("teacher"): keys.add(("teacher", props["teacher"]))
+    if _course_key(props.get("title")): keys.add(("course", _course_key(props.get("title"))))
+    if props.get("location"): keys.add(("location", props["location"]))
+    return keys
+
+def _find_cached_shift(doc_id):
+    for e in get_all_events_cached():
+        if e.get("id") == doc_id: return e.get("extendedProps", {})
+    return None
+
+def _export_filename(kind, name):
+    """檔名中的特殊字元換成 _，再加上原始名稱的短雜湊，避免 "A B" 與 "A_B" 寫到同一個檔案"""
+    safe = re.sub(r'[\\/:*?"<>|\s]', '_', name)
+    return f"{kind}_{safe}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:6]}"
+
+def _etag(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
+def _atomic_write(path, content):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f: f.write(content)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def _ics_escape(text):
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_local(iso):
+    dt = datetime.datetime.fromisoformat(iso.replace("Z", "+00:00"))
+    if dt.tzinfo: dt = dt.astimezone(pytz.timezone('Asia/Taipei')).replace(tzinfo=None)
+    return dt
+
+def _render_ics(title, shifts, holidays):
+    lines = [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//shiftar//schedule//ZH-TW", "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_ics_escape(title)}", "X-WR-TIMEZONE:Asia/Taipei",
+        "BEGIN:VTIMEZONE", "TZID:Asia/Taipei", "BEGIN:STANDARD", "DTSTART:19700101T000000",
+        "TZOFFSETFROM:+0800", "TZOFFSETTO:+0800", "TZNAME:CST", "END:STANDARD", "END:VTIMEZONE",
+    ]
+    for s in shifts:
+        s_dt, e_dt = _ics_local(s["start"]), _ics_local(s["end"] or s["start"])
+        # DTSTAMP 取自上課時間而非現在時間，內容不變時雜湊才會一致
+        stamp = pytz.timezone('Asia/Taipei').localize(s_dt).astimezone(pytz.utc).strftime("%Y%m%dT%H%M%SZ")
+        lines += [
+            "BEGIN:VEVENT", f"UID:{s['id']}@shiftar", f"DTSTAMP:{stamp}",
+            f"DTSTART;TZID=Asia/Taipei:{s_dt.strftime('%Y%m%dT%H%M%S')}", f"DTEND;TZID=Asia/Taipei:{e_dt.strftime('%Y%m%dT%H%M%S')}",
+            f"SUMMARY:{_ics_escape(s['title'])}",
+        ]
+        if s.get("teacher"): lines.append(f"DESCRIPTION:{_ics_escape('老師：' + s['teacher'])}")
+        if s.get("location"): lines.append(f"LOCATION:{_ics_escape(s['location'])}")
+        lines.append("END:VEVENT")
+    for h in holidays:
+        d = datetime.date.fromisoformat(h["date"])
+        lines += [
+            "BEGIN:VEVENT", f"UID:hol_{h['date']}@shiftar", f"DTSTAMP:{d.strftime('%Y%m%d')}T000000Z",
+            f"DTSTART;VALUE=DATE:{d.strftime('%Y%m%d')}", f"DTEND;VALUE=DATE:{(d + datetime.timedelta(days=1)).strftime('%Y%m%d')}",
+            f"SUMMARY:{_ics_escape('🌴 ' + h['description'])}", "TRANSP:TRANSPARENT", "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+def _render_feed_json(kind, name, shifts, holidays):
+    payload = {"kind": kind, "name": name, "shifts": shifts, "holidays": holidays}
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+def _export_dir():
+    """總校 (legacy_root) 沿用原本的匯出目錄，其他分校放在 tenants/<代號> 子目錄"""
+    if tenant_config("legacy_root"): return EXPORT_DIR
+    return os.path.join(EXPORT_DIR, "tenants", current_tenant())
+
+def _load_export_manifest():
+    out_dir = _export_dir()
+    try:
+        with open(os.path.join(out_dir, "manifest.json"), encoding="utf-8") as f: return json.load(f)
+    except: return None
+
+def export_static_feeds(keys=None):
+    """重新產生靜態班表檔。keys 為 None 時全部重建，否則只重建指定的 (kind, name)。回傳實際覆寫的檔名。"""
+    out_dir = _export_dir()
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = _load_export_manifest() or {"files": {}}
+    files = manifest.setdefault("files", {})
+    holidays = get_holidays_cached(datetime.date.today().year)
+    holidays_json = json.dumps(holidays, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    # 假日變動 (例如跨年) 會影響所有檔案，直接全部重建
+    if manifest.get("holidays_etag") != _etag(holidays_json): keys = None
+
+    groups = defaultdict(list)
+    for e in get_all_events_cached():
+        p = e.get("extendedProps", {})
+        for k in _shift_feed_keys(p):
+            if keys is None or k in keys:
+                groups[k].append({"id": e["id"], "title": p.get("title", ""), "start": p.get("start"), "end": p.get("end"),
+                                  "teacher": p.get("teacher", ""), "location": p.get("location", "")})
+
+    if keys is None: targets = set(groups) | {(v["kind"], v["name"]) for v in files.values()}
+    else: targets = set(keys)
+
+    written, removed = [], []
+    now_str = datetime.datetime.now().isoformat()
+    # 舊版檔名規則產生的檔案 (檔名與目前規則不符) 一併移除
+    for fname, v in list(files.items()):
+        if fname.rsplit(".", 1)[0] == _export_filename(v["kind"], v["name"]): continue
+        files.pop(fname)
+        if os.path.exists(os.path.join(out_dir, fname)): os.remove(os.path.join(out_dir, fname))
+        removed.append(fname)
+    for kind, name in targets:
+        base = _export_filename(kind, name)
+        shifts = sorted(groups.get((kind, name), []), key=lambda x: (x["start"] or "", x["id"]))
+        if not shifts:
+            # 已無任何課程：移除檔案
+            for ext in (".ics", ".json"):
+                if files.pop(base + ext, None) is None: continue
+                if os.path.exists(os.path.join(out_dir, base + ext)): os.remove(os.path.join(out_dir, base + ext))
+                removed.append(base + ext)
+            continue
+        label = {"teacher": "老師", "course": "課程", "location": "地點"}[kind]
+        rendered = {
+            ".ics": _render_ics(f"{tenant_config('name', '')} {label}：{name}", shifts, holidays),
+            ".json": _render_feed_json(kind, name, shifts, holidays),
+        }
+        for ext, content in rendered.items():
+            tag = _etag(content)
+            if files.get(base + ext, {}).get("etag") == tag and os.path.exists(os.path.join(out_dir, base + ext)): continue
+            _atomic_write(os.path.join(out_dir, base + ext), content)
+            files[base + ext] = {"kind": kind, "name": name, "etag": tag, "updated_at": now_str}
+            written.append(base + ext)
+
+    if manifest.get("holidays_etag") != _etag(holidays_json) or not os.path.exists(os.path.join(out_dir, "holidays.json")):
+        _atomic_write(os.path.join(out_dir, "holidays.json"), holidays_json)
+        written.append("holidays.json")
+    manifest["holidays_etag"] = _etag(holidays_json)
+    if written or removed or _load_export_manifest() is None:
+        manifest["generated_at"] = now_str
+        _atomic_write(os.path.join(out_dir, "manifest.json"), json.dumps(manifest, ensure_ascii=False, sort_keys=True, indent=1))
+    return written
+
+def refresh_static_exports(keys):
+    """行程異動後呼叫：只重建受影響的檔案；尚未匯出過則全部建立。匯出失敗不影響主要操作。"""
+    try:
+        if _load_export_manifest() is None: export_static_feeds()
+        elif keys: export_static_feeds(keys)
+    except Exception as e:
+        st.toast(f"班表匯出更新失敗: {e}", icon="⚠️")
+
+# --- 公告 ---
+# announcements/<id> = {title, category, date (YYYY-MM-DD), done, created_by, created_at}
+# 依 (category, date) 建立複合索引 (見 firestore.indexes.json)，以分頁方式查詢。
+# 行事曆只顯示 announcement_badges/<YYYY-MM> 中預先統計的「每日各分類件數」，點開當天才讀取內容。
+def _badge_counts(notice):
+    """一則公告在徽章統計中的貢獻；已完成的任務不列入"""
+    if not notice or (notice.get("category") == "任務" and notice.get("done")): return {}
+    return {(notice["date"], notice.get("category", "其他")): 1}
+
+def _apply_badge_delta(batch, before, after):
+    delta = defaultdict(int)
+    for k, v in _badge_counts(before).items(): delta[k] -= v
+    for k, v in _badge_counts(after).items(): delta[k] += v
+    for (date_str, cat), n in delta.items():
+        if n: batch.set(tenant_col("announcement_badges").document(date_str[:7]), {"days": {date_str: {cat: firestore.Increment(n)}}}, merge=True)
+
+def _clear_notice_caches():
+    get_announcement_badges_cached.clear()
+    get_announcements_cached.clear()
+
+def add_announcement(title, category, date, user):
+    data = {"title": title, "category": category, "date": date.isoformat(), "done": False, "created_by": user, "created_at": datetime.datetime.now().isoformat()}
+    ref = tenant_col("announcements").document()
+    batch = db.batch()
+    batch.set(ref, data)
+    _apply_badge_delta(batch, None, data)
+    batch.commit()
+    log_mutation("add_announcement", "announcements", ref.id, None, data)
+    _clear_notice_caches()
+
+def update_announcement(doc_id, before, update_dict):
+    after = {**before, **update_dict}
+    batch = db.batch()
+    batch.update(tenant_col("announcements").document(doc_id), update_dict)
+    _apply_badge_delta(batch, before, after)
+    batch.commit()
+    log_mutation("update_announcement", "announcements", doc_id, before, after)
+    _clear_notice_caches()
+
+def delete_announcement(doc_id, before):
+    batch = db.batch()
+    batch.delete(tenant_col("announcements").document(doc_id))
+    _apply_badge_delta(batch, before, None)
+    batch.commit()
+    log_mutation("delete_announcement", "announcements", doc_id, before, None)
+    _clear_notice_caches()
+
+def get_announcements(category=None, start=None, end=None, open_only=False, limit=20, cursor=None):
+    """分頁查詢公告，依日期排序。回傳 (該頁公告, 下一頁 cursor)；cursor 為 None 表示沒有下一頁"""
+    q = tenant_col("announcements")
+    if category: q = q.where(filter=firestore.FieldFilter("category", "==", category))
+    if open_only: q = q.where(filter=firestore.FieldFilter("done", "==", False))
+    if start: q = q.where(filter=firestore.FieldFilter("date", ">=", start))
+    if end: q = q.where(filter=firestore.FieldFilter("date", "<=", end))
+    q = q.order_by("date")
+    if cursor: q = q.start_after(tenant_col("announcements").document(cursor).get())
+    docs = list(q.limit(limit + 1).stream())
+    items = [{**doc.to_dict(), "id": doc.id} for doc in docs[:limit]]
+    return items, (items[-1]["id"] if len(docs) > limit else None)
+
+@tenant_cache(st.cache_data(ttl=300))
+def get_announcements_cached(category=None, start=None, end=None, open_only=False, limit=20):
+    return get_announcements(category, start, end, open_only, limit)[0]
+
+@tenant_cache(st.cache_data(ttl=600))
+def get_announcement_badges_cached():
+    return {doc.id: doc.to_dict().get("days", {}) for doc in tenant_col("announcement_badges").stream()}
+
+def get_notice_badge_events():
+    """行事曆用：每天每個分類一個全天事件，只帶件數"""
+    events = []
+    for days in get_announcement_badges_cached().values():
+        for date_str, cats in days.items():
+            for cat, n in cats.items():
+                if n <= 0: continue
+                title = f"[{cat}] {n} 則" if cat != "任務" else f"🔥 [任務] {n} 項"
+                events.append({"id": f"notice_{date_str}_{cat}", "title": title, "start": date_str, "allDay": True,
+                               "color": NOTICE_COLORS.get(cat, "#ffc107"), "editable": False,
+                               "extendedProps": {"type": "notice_badge", "date": date_str, "category": cat}})
+    return events
+
+def migrate_notices_to_announcements():
+    """一次性：把 shifts 中 type == notice 的文件搬到 announcements 並重建徽章統計"""
+    moved = 0
+    for doc in tenant_col("shifts").where(filter=firestore.FieldFilter("type", "==", "notice")).stream():
+        d = doc.to_dict()
+        data = {"title": d.get("title", ""), "category": d.get("category") or "其他", "date": str(d.get("start", ""))[:10],
+                "done": False, "created_by": d.get("staff", ""), "created_at": str(d.get("created_at", ""))}
+        batch = db.batch()
+        batch.set(tenant_col("announcements").document(doc.id), data)
+        batch.delete(doc.reference)
+        _apply_badge_delta(batch, None, data)
+        batch.commit()
+        moved += 1
+    tenant_col("settings").document("announcements_meta").set({"migrated_at": datetime.datetime.now().isoformat(), "moved": moved})
+    get_all_events_cached.clear()
+    return moved
+
+@tenant_cache(st.cache_resource)
+def ensure_announcements():
+    def check():
+        if not tenant_col("settings").document("announcements_meta").get().exists: migrate_notices_to_announcements()
+        return True
+    return read_with_fallback("ensured/announcements", check)
+
 def get_cleaning_status(area):
-    doc = db.collection("latest_cleaning_status").document(area).get()
-    return doc.to_dict() if doc.exists else None
+    pending = get_write_queue().latest("cleaning", area)
+    if pending: return pending
+    def fetch():
+        doc = tenant_col("latest_cleaning_status").document(area).get()
+        return doc.to_dict() if doc.exists else None
+    return read_with_fallback(f"cleaning/{area}", fetch)
 
 def log_cleaning(area, user):
-    now = datetime.datetime.now()
-    db.collection("cleaning_logs").add({"area": area, "staff": user, "timestamp": now})
-    db.collection("latest_cleaning_status").document(area).set({"area": area, "staff": user, "timestamp": now})
+    get_write_queue().put("cleaning", area, {"area": area, "staff": user, "timestamp": datetime.datetime.now().isoformat()})
     st.toast(f"✨ {area} 清潔完成！", icon="🧹")
 
+# --- 離線寫入佇列 ---
+# 櫃檯網路不穩時點名與清潔紀錄不能遺失：先寫入伺服器本機的 SQLite 立即回報成功，
+# 再由背景執行緒依序批次同步到 Firestore。每筆寫入有固定 ID，重送不會重複寫入。
+# 連線問題會一直重試；其他錯誤 (資料或權限問題) 重試 WRITE_QUEUE_MAX_ATTEMPTS 次後移到 dead_writes，
+# 不再擋住之後的寫入，並顯示在同步狀態讓人處理。重新同步時保留原本的順序 (seq)；
+# 同一天之後已有較新點名 (已同步或仍在佇列) 的舊點名不再重送，以免蓋掉較新的紀錄。
+# 讀取也在本機保留一份最後成功讀到的內容 (read_cache)，斷線時畫面改用這份資料。
+WRITE_QUEUE_PATH = "write_queue.sqlite3"
+WRITE_QUEUE_BATCH = 100
+WRITE_QUEUE_MAX_ATTEMPTS = 5
+WRITE_QUEUE_TRANSIENT_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                                google_exceptions.RetryError, ConnectionError, TimeoutError)
+
+class _WriteQueue:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.last_error = None
+        self.read_error = None
+        self.remembered = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS pending_writes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, tenant TEXT NOT NULL, kind TEXT NOT NULL,
+            doc_id TEXT NOT NULL, payload TEXT NOT NULL, actor TEXT, created_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS dead_writes (
+            seq INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, tenant TEXT NOT NULL, kind TEXT NOT NULL,
+            doc_id TEXT NOT NULL, payload TEXT NOT NULL, actor TEXT, created_at TEXT NOT NULL,
+            attempts INTEGER NOT NULL, last_error TEXT, failed_at TEXT NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS synced_writes (
+            tenant TEXT NOT NULL, kind TEXT NOT NULL, doc_id TEXT NOT NULL, seq INTEGER NOT NULL, PRIMARY KEY (tenant, kind, doc_id))""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS read_cache (
+            tenant TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated_at TEXT NOT NULL, PRIMARY KEY (tenant, key))""")
+        threading.Thread(target=self._run, name="write-queue", daemon=True).start()
+
+    def put(self, kind, doc_id, payload):
+        entry_id = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:8]}"
+        with self.lock:
+            self.conn.execute("INSERT INTO pending_writes (id, tenant, kind, doc_id, payload, actor, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (entry_id, current_tenant(), kind, doc_id, json.dumps(payload, ensure_ascii=False, default=str),
+                               _current_actor(), datetime.datetime.now().isoformat()))
+        self.wake.set()
+        return entry_id
+
+    def latest(self, kind, doc_id):
+        """尚未同步的最新內容 (本機讀取以此為準)"""
+        with self.lock:
+            row = self.conn.execute("SELECT payload FROM pending_writes WHERE tenant = ? AND kind = ? AND doc_id = ? ORDER BY seq DESC LIMIT 1",
+                                    (current_tenant(), kind, doc_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def remember(self, key, value):
+        """記下最後一次成功讀到的內容；內容沒變就不重寫"""
+        raw = json.dumps(value, ensure_ascii=False, default=str)
+        if self.remembered.get((current_tenant(), key)) == raw: return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO read_cache (tenant, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                              (current_tenant(), key, raw, datetime.datetime.now().isoformat()))
+        self.remembered[(current_tenant(), key)] = raw
+
+    def recall(self, key):
+        """最後一次成功讀到的內容；沒讀過時拋出 KeyError"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM read_cache WHERE tenant = ? AND key = ?", (current_tenant(), key)).fetchone()
+        if not row: raise KeyError(key)
+        return json.loads(row[0])
+
+    def status(self):
+        with self.lock:
+            pending, oldest = self.conn.execute("SELECT COUNT(*), MIN(created_at) FROM pending_writes WHERE tenant = ?", (current_tenant(),)).fetchone()
+            dead = self.conn.execute("SELECT COUNT(*) FROM dead_writes WHERE tenant = ?", (current_tenant(),)).fetchone()[0]
+        return {"pending": pending, "oldest": oldest, "error": self.last_error if pending else None, "dead": dead, "offline_reads": self.read_error}
+
+    # 失敗的點名之後，同一天已有較新的寫入 (已同步或仍在佇列)
+    _SUPERSEDED = """d.kind = 'roll_call' AND (
+        EXISTS (SELECT 1 FROM synced_writes w WHERE w.tenant = d.tenant AND w.kind = d.kind AND w.doc_id = d.doc_id AND w.seq > d.seq)
+        OR EXISTS (SELECT 1 FROM pending_writes p WHERE p.tenant = d.tenant AND p.kind = d.kind AND p.doc_id = d.doc_id AND p.seq > d.seq))"""
+
+    def dead(self):
+        with self.lock:
+            rows = self.conn.execute(f"""SELECT id, kind, doc_id, actor, created_at, attempts, last_error, failed_at, {self._SUPERSEDED}
+                FROM dead_writes d WHERE tenant = ? ORDER BY seq""", (current_tenant(),)).fetchall()
+        return [dict(zip(["id", "kind", "doc_id", "actor", "created_at", "attempts", "last_error", "failed_at", "superseded"], (*r[:-1], bool(r[-1])))) for r in rows]
+
+    def retry_dead(self):
+        """把同步失敗的寫入以原本的 seq 放回佇列，依原順序重新同步；已被較新點名取代的留在失敗清單"""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute(f"""INSERT INTO pending_writes (seq, id, tenant, kind, doc_id, payload, actor, created_at)
+                SELECT seq, id, tenant, kind, doc_id, payload, actor, created_at FROM dead_writes d WHERE tenant = ? AND NOT ({self._SUPERSEDED})""", (current_tenant(),))
+            self.conn.execute("DELETE FROM dead_writes WHERE tenant = ? AND id IN (SELECT id FROM pending_writes)", (current_tenant(),))
+            self.conn.execute("COMMIT")
+        self.wake.set()
+
+    def discard_dead(self):
+        with self.lock:
+            n = self.conn.execute("DELETE FROM dead_writes WHERE tenant = ?", (current_tenant(),)).rowcount
+        logger.warning("discarded %d failed writes for %s (by %s)", n, current_tenant(), _current_actor())
+
+    def _fail(self, group, ex):
+        """記錄失敗並回傳這組目前的重試次數；超過上限就整組移到 dead_writes"""
+        marks = ",".join("?" * len(group["seqs"]))
+        with self.lock:
+            self.conn.execute(f"UPDATE pending_writes SET attempts = attempts + 1, last_error = ? WHERE seq IN ({marks})", (str(ex), *group["seqs"]))
+            attempts = self.conn.execute(f"SELECT MAX(attempts) FROM pending_writes WHERE seq IN ({marks})", group["seqs"]).fetchone()[0]
+            if attempts < WRITE_QUEUE_MAX_ATTEMPTS: return attempts
+            self.conn.execute("BEGIN")
+            self.conn.execute(f"""INSERT INTO dead_writes (seq, id, tenant, kind, doc_id, payload, actor, created_at, attempts, last_error, failed_at)
+                SELECT seq, id, tenant, kind, doc_id, payload, actor, created_at, attempts, last_error, ? FROM pending_writes WHERE seq IN ({marks})""",
+                              (datetime.datetime.now().isoformat(), *group["seqs"]))
+            self.conn.execute(f"DELETE FROM pending_writes WHERE seq IN ({marks})", group["seqs"])
+            self.conn.execute("COMMIT")
+        return attempts
+
+    def _run(self):
+        delay = 0
+        while True:
+            self.wake.wait(timeout=delay)
+            self.wake.clear()
+            # 各分校各取一批，某分校卡住時不影響其他分校
+            with self.lock:
+                tenants = [r[0] for r in self.conn.execute("SELECT DISTINCT tenant FROM pending_writes").fetchall()]
+                rows = [row for t in tenants for row in self.conn.execute(
+                    "SELECT seq, id, tenant, kind, doc_id, payload, actor FROM pending_writes WHERE tenant = ? ORDER BY seq LIMIT ?", (t, WRITE_QUEUE_BATCH)).fetchall()]
+            if not rows:
+                delay = 30; continue
+            delay = 0
+            blocked = set()
+            for group in _group_pending_writes(rows):
+                if group["tenant"] in blocked: continue
+                try:
+                    with tenant_scope(group["tenant"]): _REPLAYERS[group["kind"]](group)
+                except Exception as ex:
+                    self.last_error = str(ex)
+                    if isinstance(ex, WRITE_QUEUE_TRANSIENT_ERRORS):
+                        logger.warning("write queue offline, retrying: %s", ex)
+                    elif self._fail(group, ex) >= WRITE_QUEUE_MAX_ATTEMPTS:
+                        logger.error("write queue gave up on %s %s after %d attempts: %s", group["kind"], group["doc_id"], WRITE_QUEUE_MAX_ATTEMPTS, ex)
+                        continue
+                    else:
+                        logger.warning("write queue replay failed, retrying: %s", ex)
+                    # 依序重送：同一分校在失敗的這組之後的寫入也先等待，避免順序錯亂
+                    blocked.add(group["tenant"])
+                    delay = 5
+                    continue
+                with self.lock:
+                    self.conn.executemany("DELETE FROM pending_writes WHERE seq = ?", [(q,) for q in group["seqs"]])
+                    if group["kind"] == "roll_call": self.conn.execute("""INSERT INTO synced_writes (tenant, kind, doc_id, seq) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (tenant, kind, doc_id) DO UPDATE SET seq = MAX(seq, excluded.seq)""",
+                                      (group["tenant"], group["kind"], group["doc_id"], group["seqs"][-1]))
+            if not blocked: self.last_error = None
+
+@st.cache_resource
+def get_write_queue():
+    return _WriteQueue(WRITE_QUEUE_PATH)
+
+def read_with_fallback(key, fetch):
+    """讀取成功時在本機記下結果；讀取失敗 (斷線) 時改回傳上次成功讀到的內容，沒有的話照樣拋出錯誤"""
+    q = get_write_queue()
+    try:
+        value = fetch()
+    except Exception as ex:
+        try: value = q.recall(key)
+        except KeyError: raise ex
+        logger.warning("read %s failed, serving last known value: %s", key, ex)
+        q.read_error = str(ex)
+        return value
+    q.remember(key, value)
+    q.read_error = None
+    return value
+
+def _group_pending_writes(rows):
+    """同一天的點名合併成一次寫入 (base 取第一筆、內容取最後一筆)；同一分校的清潔紀錄合併成一個 batch"""
+    groups = {}
+    for seq, entry_id, tenant, kind, doc_id, payload, actor in rows:
+        g = groups.setdefault((tenant, kind, doc_id if kind == "roll_call" else ""),
+                              {"tenant": tenant, "kind": kind, "doc_id": doc_id, "seqs": [], "entries": []})
+        g["seqs"].append(seq)
+        g["entries"].append({**json.loads(payload), "id": entry_id, "actor": actor})
+    return sorted(groups.values(), key=lambda g: g["seqs"][0])
+
+def _replay_roll_call(group):
+    first, last = group["entries"][0], group["entries"][-1]
+    save_roll_call_to_db(group["doc_id"], last["data"], base=first["base"], write_id=last["id"], actor=last["actor"])
+
+def _replay_cleaning(group):
+    latest = {e["area"]: e for e in group["entries"]}
+    refs = [tenant_col("latest_cleaning_status").document(area) for area in latest]
+    current = {snap.id: snap.to_dict() for snap in db.get_all(refs) if snap.exists}
+    batch = db.batch()
+    for e in group["entries"]:
+        batch.set(tenant_col("cleaning_logs").document(e["id"]), {"area": e["area"], "staff": e["staff"], "timestamp": datetime.datetime.fromisoformat(e["timestamp"])})
+    for area, e in latest.items():
+        ts = datetime.datetime.fromisoformat(e["timestamp"])
+        cur_ts = (current.get(area) or {}).get("timestamp")
+        if isinstance(cur_ts, str): cur_ts = datetime.datetime.fromisoformat(cur_ts)
+        # 其他裝置已記錄較新的清潔時間時不覆蓋
+        if cur_ts and cur_ts.replace(tzinfo=None) >= ts: continue
+        batch.set(tenant_col("latest_cleaning_status").document(area), {"area": area, "staff": e["staff"], "timestamp": ts})
+    batch.commit()
+    for e in group["entries"]:
+        log_mutation("log_cleaning", "cleaning_logs", e["id"], None, {"area": e["area"], "staff": e["staff"], "timestamp": e["timestamp"]}, actor=e["actor"])
+
+_REPLAYERS = {"roll_call": _replay_roll_call, "cleaning": _replay_cleaning}
+
+def enqueue_roll_call(date_str, base, data):
+    """點名先存入本機佇列；base 是畫面上看到的紀錄，同步時用來判斷其他裝置是否也改過"""
+    get_write_queue().put("roll_call", date_str, {"base": base, "data": data})
+
+def get_roll_call_state(date_str):
+    """尚未同步的點名以本機佇列為準"""
+    pending = get_write_queue().latest("roll_call", date_str)
+    return pending["data"] if pending else get_roll_call_from_db(date_str)
+
+# --- 排程工作 ---
+# 伺服器程序內的背景排程：每天早上預先算好當天點名名單、試聽追蹤清單、月統計並更新假日快取，
+# 06:00 更新登出時間點。頁面 rerun 時只讀取這裡的結果，結果失效 (資料異動) 時才當場重算。
+DAILY_JOB_TIME = datetime.time(5, 30)
+LOGOUT_TIME = datetime.time(6, 0)
+
+class _Scheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.last_run = {}
+        self.jobs = [("daily", DAILY_JOB_TIME, run_daily_jobs), ("logout", LOGOUT_TIME, _update_logout_epoch)]
+        threading.Thread(target=self._run, name="scheduler", daemon=True).start()
+
+    # 結果依分校分開存放
+    def get(self, key):
+        with self.lock: return self.results.get((current_tenant(), key))
+
+    def set(self, key, value):
+        with self.lock: self.results[(current_tenant(), key)] = value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys: self.results.pop((current_tenant(), key), None)
+
+    def _run(self):
+        while True:
+            now = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
+            for name, at, job in self.jobs:
+                # 最近一次應執行的日期；程序剛啟動時會先補跑一次
+                due = now.date() if now.time() >= at else now.date() - datetime.timedelta(days=1)
+                if self.last_run.get(name) == due: continue
+                self.last_run[name] = due
+                # 以台北日期執行 (與判斷是否到期的時間一致)；各分校分別執行，一個分校失敗不影響其他分校
+                for tenant in TENANTS:
+                    with tenant_scope(tenant):
+                        try: job(self, now.date())
+                        except Exception: logger.exception("scheduled job %s failed for %s", name, tenant)
+            time.sleep(30)
+
+@st.cache_resource
+def get_scheduler():
+    return _Scheduler()
+
+def _update_logout_epoch(scheduler, today):
+    now = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
+    last = datetime.datetime.combine(today if now.time() >= LOGOUT_TIME else today - datetime.timedelta(days=1), LOGOUT_TIME)
+    scheduler.set("logout_epoch", pytz.timezone('Asia/Taipei').localize(last).isoformat())
+
+def get_logout_epoch():
+    epoch = get_scheduler().get("logout_epoch")
+    if epoch is None:
+        _update_logout_epoch(get_scheduler(), datetime.datetime.now(pytz.timezone('Asia/Taipei')).date())
+        epoch = get_scheduler().get("logout_epoch")
+    return epoch
+
+def build_roll_call_plan(date_key):
+    """某天的點名名單：當天課程、上課地點與各課程應到學生 (已排除離班)"""
+    course_students = defaultdict(list)
+    for s in get_students_data_cached():
+        c, sid = s.get('班別'), s.get('sid')
+        if not c or not sid: continue
+        if s.get('leaving_date') and date_key > s['leaving_date']: continue
+        if sid not in course_students[c]: course_students[c].append(sid)
+    courses, locations = [], {}
+    for e in get_events_between(date_key, date_key):
+        props = e.get('extendedProps', {})
+        if e.get('start', '').startswith(date_key) and props.get('type') == 'shift':
+            c_title = props.get('title', '')
+            courses.append(c_title)
+            locations[c_title] = get_course_location(c_title, props.get('location', ''))
+    targets = list(dict.fromkeys(sid for c in courses for sid in course_students.get(c, [])))
+    return {"date": date_key, "courses": courses, "locations": locations,
+            "course_students": {c: course_students.get(c, []) for c in set(courses)}, "targets": targets}
+
+def get_roll_call_plan(date_key):
+    """當天的名單由排程預先算好；其他日期或名單/課表異動後才重新計算"""
+    cached = get_scheduler().get("roll_call_plan")
+    if cached and cached["date"] == date_key: return cached
+    plan = read_with_fallback(f"roll_call_plan/{date_key}", lambda: build_roll_call_plan(date_key))
+    if date_key == taipei_today().isoformat(): get_scheduler().set("roll_call_plan", plan)
+    return plan
+
+def build_trial_follow_ups(today):
+    """試聽滿 7 天仍未決定去留的試聽生"""
+    follow_ups = []
+    for t in get_trial_students():
+        try:
+            if today >= datetime.date.fromisoformat(t['trial_date']) + datetime.timedelta(days=7): follow_ups.append(t)
+        except: pass
+    return follow_ups
+
+def get_trial_follow_ups():
+    today = taipei_today()
+    cached = get_scheduler().get("trial_follow_ups")
+    if cached and cached[0] == today: return cached[1]
+    follow_ups = build_trial_follow_ups(today)
+    get_scheduler().set("trial_follow_ups", (today, follow_ups))
+    return follow_ups
+
+def _event_hours(props):
+    try:
+        s_dt = datetime.datetime.fromisoformat(props['start'].replace("Z", "+00:00"))
+        e_dt = datetime.datetime.fromisoformat(props['end'].replace("Z", "+00:00"))
+        return max(0.0, (e_dt - s_dt).total_seconds() / 3600)
+    except: return 0.0
+
+def compute_monthly_aggregates(month):
+    """aggregates/<YYYY-MM>：當月點名人次、老師授課時數與薪資、工讀生時數"""
+    attendance = {s: 0 for s in ROLL_CALL_STATUSES}
+    for rec in get_roll_calls_between(f"{month}-01", f"{month}-31").values():
+        for status in ROLL_CALL_STATUSES: attendance[status] += len(rec.get(status, []))
+    teacher_hours, part_time_hours = defaultdict(float), defaultdict(float)
+    for e in get_events_between(f"{month}-01", f"{month}-31"):
+        p = e.get('extendedProps', {})
+        if not str(p.get('start', '')).startswith(month): continue
+        if p.get('type') == 'shift' and p.get('teacher'): teacher_hours[p['teacher']] += _event_hours(p)
+        elif p.get('type') == 'part_time' and p.get('staff'): part_time_hours[p['staff']] += _event_hours(p)
+    rates = get_teachers_data()
+    teacher_pay = {t: round(h * float(rates.get(t, {}).get("rate", 0) or 0)) for t, h in teacher_hours.items()}
+    data = {"month": month, "attendance": attendance, "teacher_hours": dict(teacher_hours), "teacher_pay": teacher_pay,
+            "part_time_hours": dict(part_time_hours), "updated_at": datetime.datetime.now().isoformat()}
+    tenant_col("aggregates").document(month).set(data)
+    return data
+
+@tenant_cache(st.cache_data(ttl=3600))
+def get_monthly_aggregates_cached(month):
+    doc = tenant_col("aggregates").document(month).get()
+    return doc.to_dict() if doc.exists else None
+
+def run_daily_jobs(scheduler, today):
+    ensure_roll_call_index()
+    get_holidays_cached.clear()
+    get_holidays_cached(today.year)
+    # 當天名單只預先算好放在排程快取，不寫入點名紀錄：課程取消或名單異動時快取失效後重算，
+    # 不會有人在上課前就被記成未到
+    scheduler.set("roll_call_plan", build_roll_call_plan(today.isoformat()))
+    scheduler.set("trial_follow_ups", (today, build_trial_follow_ups(today)))
+    months = {today.strftime("%Y-%m"), (today.replace(day=1) - datetime.timedelta(days=1)).strftime("%Y-%m")}
+    for month in months: compute_monthly_aggregates(month)
+    get_monthly_aggregates_cached.clear()
+    archive_old_terms()
+    compact_audit_log()
+    scheduler.set("daily_run_at", datetime.datetime.now().isoformat())
+
+def build_tenant_rollup(month, tenants=None):
+    """各分校當月出缺勤與薪資總表：只讀各分校的 aggregates/<YYYY-MM>，不掃描原始資料。
+    tenants 未指定時為全部分校。回傳 (各分校一列的總表, 老師跨分校薪資表)"""
+    rows, pay_rows = [], []
+    for tenant in tenants or TENANTS:
+        with tenant_scope(tenant): agg = get_monthly_aggregates_cached(month) or {}
+        name, att = tenant_config("name", tenant, tenant), agg.get("attendance", {})
+        rows.append({"分校": name, "出席": att.get("present", 0), "請假": att.get("leave", 0), "缺席": att.get("absent", 0),
+                     "授課時數": round(sum(agg.get("teacher_hours", {}).values()), 1), "老師薪資": sum(agg.get("teacher_pay", {}).values()),
+                     "工讀時數": round(sum(agg.get("part_time_hours", {}).values()), 1), "統計時間": agg.get("updated_at", "尚未統計")[:16]})
+        for t, pay in agg.get("teacher_pay", {}).items():
+            pay_rows.append({"老師": t, "分校": name, "時數": round(agg.get("teacher_hours", {}).get(t, 0), 1), "薪資": pay})
+    summary = pd.DataFrame(rows)
+    if len(summary) > 1:
+        total = {c: summary[c].sum() for c in summary.columns if c not in ("分校", "統計時間")}
+        summary = pd.concat([summary, pd.DataFrame([{"分校": "合計", **total, "統計時間": ""}])], ignore_index=True)
+    payroll = pd.DataFrame(pay_rows, columns=["老師", "分校", "時數", "薪資"])
+    if not payroll.empty:
+        payroll = payroll.pivot_table(index="老師", columns="分校", values="薪資", aggfunc="sum", fill_value=0)
+        payroll["合計"] = payroll.sum(axis=1)
+        payroll = payroll.sort_values("合計", ascending=False).reset_index()
+    return summary, payroll
+
 # --- 4. Dialogs ---
 @st.dialog("✏️ 編輯/刪除 行程")
 def show_edit_event_dialog(event_id, props):
@@ -319,39 +1783,49 @@ def show_edit_event_dialog(event_id, props):
             update_event_in_db(event_id, {"staff": new_staff, "start": s_new.isoformat(), "end": e_new.isoformat()}); st.rerun()
         if b2.button("🗑️ 刪除"): delete_event_from_db(event_id); st.rerun()
 
-    elif props.get('type') == 'notice':
-        cats = ["調課", "考試", "活動", "任務", "其他"]
-        n_cat = st.selectbox("分類", cats, index=cats.index(props.get('category', '其他')) if props.get('category') in cats else 4)
-        n_con = st.text_area("內容", props.get('title'))
-        b1, b2 = st.columns(2)
-        if b1.button("💾 儲存"): update_event_in_db(event_id, {"title": n_con, "category": n_cat}); st.rerun()
-        if b2.button("🗑️ 刪除"): delete_event_from_db(event_id); st.rerun()
     else:
         if st.button("🗑️ 強制刪除"): delete_event_from_db(event_id); st.rerun()
 
-@st.dialog("📢 新增公告")
-def show_notice_dialog(default_date=None):
-    if not default_date: default_date = datetime.date.today()
-    st.info(f"建立 {default_date} 的事項")
-    d = st.date_input("日期", default_date)
-    cat = st.selectbox("分類", ["調課", "考試", "活動", "任務", "其他"])
-    con = st.text_area("內容")
-    if st.button("發布"):
-        s = datetime.datetime.combine(d, datetime.time(9,0)); e = datetime.datetime.combine(d, datetime.time(10,0))
-        add_event_to_db(con, s, e, "notice", st.session_state['user'], category=cat); st.toast("已發布"); st.rerun()
+@st.dialog("📢 當日公告")
+def show_day_notices_dialog(date_str):
+    # 徽章不計已完成的任務，所以點日期也從這裡進來：列出當天全部事項 (含已完成) 並可新增
+    items, _ = get_announcements(start=date_str, end=date_str, limit=50)
+    st.info(f"{date_str} 的事項")
+    if not items: st.caption("無公告")
+    for n in items:
+        with st.container(border=True):
+            cats = NOTICE_CATEGORIES
+            n_cat = st.selectbox("分類", cats, index=cats.index(n.get('category')) if n.get('category') in cats else 4, key=f"n_cat_{n['id']}")
+            n_con = st.text_area("內容", n.get('title', ''), key=f"n_con_{n['id']}")
+            n_done = st.checkbox("已完成", value=bool(n.get('done')), key=f"n_done_{n['id']}") if n_cat == "任務" else False
+            before = {k: v for k, v in n.items() if k != "id"}
+            b1, b2 = st.columns(2)
+            if b1.button("💾 儲存", key=f"n_save_{n['id']}"):
+                update_announcement(n['id'], before, {"title": n_con, "category": n_cat, "done": n_done}); st.rerun()
+            if b2.button("🗑️ 刪除", key=f"n_del_{n['id']}"):
+                delete_announcement(n['id'], before); st.rerun()
+
+    with st.expander("➕ 新增公告", expanded=not items):
+        d = st.date_input("日期", datetime.date.fromisoformat(date_str), key="n_new_date")
+        cat = st.selectbox("分類", NOTICE_CATEGORIES, key="n_new_cat")
+        con = st.text_area("內容", key="n_new_con")
+        if st.button("發布", key="n_new_add"):
+            add_announcement(con, cat, d, st.session_state['user']); st.toast("已發布"); st.rerun()
 
 @st.dialog("📅 紀錄檢視")
 def show_roll_call_review_dialog():
-    recs = get_all_roll_calls()
+    # 預設只列出目前 (未封存) 的紀錄，較早的學期選擇後才讀取封存資料
+    archived = sorted(get_archive_meta_cached().get("terms", {}).get("roll_call_records", {}), reverse=True)
+    term = st.selectbox("學期", ["目前"] + archived, format_func=lambda t: t if t == "目前" else f"{get_term_range(datetime.date.fromisoformat(t + '-01'))[2]} (已封存)") if archived else "目前"
+    recs = get_all_roll_calls() if term == "目前" else get_archived_term("roll_call_records", term)
     if not recs: st.info("無紀錄"); return
     
     d_loc = {}
-    for e in get_all_events_cached():
+    for e in get_events_between(min(recs), max(recs)):
         sd = e.get('start', '').split('T')[0]
         p = e.get('extendedProps', {})
         if p.get('type')=='shift':
-            loc = p.get('location', '')
-            if loc=='線上': loc='櫃檯'
+            loc = get_course_location(p.get('title', ''), p.get('location', ''))
             if sd not in d_loc: d_loc[sd]=[]
             if loc and loc not in d_loc[sd]: d_loc[sd].append(loc)
 
@@ -368,7 +1842,7 @@ def show_roll_call_review_dialog():
 
 @st.dialog("📂 資料管理")
 def show_general_management_dialog():
-    tab1, tab2, tab3, tab4 = st.tabs(["🎓 學生名單", "👷 工讀生", "🎧 試聽與潛在名單", "🛠️ 教學工具"])
+    tab1, tab2, tab_course, tab3, tab4 = st.tabs(["🎓 學生名單", "👷 工讀生", "📚 課程", "🎧 試聽與潛在名單", "🛠️ 教學工具"])
     
     # --- Tab 1: 學生名單 ---
     with tab1:
@@ -378,38 +1852,26 @@ def show_general_management_dialog():
         with st.expander("👋 辦理離班/退班"):
             st.warning("設定後，學生將於「最後上課日」隔天起自動從點名表移除，但資料會保留。")
             
-            active_opts = []
-            for s in current_students:
-                name = s.get('姓名')
-                c = s.get('班別')
-                leave_date = s.get('leaving_date')
-                label = f"{name} ({c})"
-                if leave_date: label += f" [已設離班: {leave_date}]"
-                active_opts.append(label)
+            sel_row = roster_picker("選擇學生", key="leave_pick")
             
-            sel_student_label = st.selectbox("選擇學生", ["請選擇"] + active_opts)
-            
-            if sel_student_label != "請選擇":
+            if sel_row != "請選擇":
                 c1, c2 = st.columns(2)
                 last_date = c1.date_input("最後上課日 (該日之後將不再點名)")
                 refund = c2.checkbox("需要計算退費 (待結算)", value=False)
                 
                 if refund:
-                    st.info("💡 提示：退費系統開發中，此標記將用於未來的財務報表提醒。")
+                    st.info("💡 提示：標記後會列在「名單報表」的待退費名單，結算後再於該處勾選完成。")
                 
                 if st.button("確認辦理離班", type="primary"):
-                    target_name = sel_student_label.split(" (")[0]
-                    target_course = sel_student_label.split("(")[1].split(")")[0] 
-                    
                     updated_list = []
                     for s in current_students:
-                        if s.get('姓名') == target_name and s.get('班別') == target_course:
+                        if student_row_key(s) == sel_row:
                             s['leaving_date'] = last_date.isoformat()
                             s['refund_needed'] = refund
                         updated_list.append(s)
                     
                     save_students_data(updated_list)
-                    st.success(f"已設定 {target_name} 於 {last_date} 離班。")
+                    st.success(f"已設定 {get_roster_labels([sel_row]).get(sel_row, '').split(' [已設離班')[0]} 於 {last_date} 離班。")
                     time.sleep(1)
                     st.rerun()
 
@@ -443,7 +1905,7 @@ def show_general_management_dialog():
                             phone_clean = re.sub(r'[^\d\-]', '', raw_cont)
                             raw_courses = str(row[c_course]).strip() if pd.notna(row[c_course]) else ""
                             courses = [c.strip() for c in raw_courses.replace("\n", ",").split(",") if c.strip()]
-                            base = {"姓名": name, "年級": grade, "學生手機": phone_clean, "家裡": "", "爸爸": "", "媽媽": ""}
+                            base = {"sid": find_student_id(current_students + new_data, name, grade, phone_clean), "姓名": name, "年級": grade, "學生手機": phone_clean, "家裡": "", "爸爸": "", "媽媽": "", "joined_date": datetime.date.today().isoformat()}
                             if not courses: new_data.append({**base, "班別": "未分班"})
                             else: 
                                 for c in courses: new_data.append({**base, "班別": c})
@@ -453,6 +1915,8 @@ def show_general_management_dialog():
 
         # 3. 手動新增
         with st.expander("手動新增"):
+            # 既有學生加報其他班時直接選人，共用同一個 sid；沒選就當作新學生
+            n_existing = roster_picker("既有學生 (新學生不用選)", key="add_existing_pick")
             c1, c2 = st.columns(2)
             n_name = c1.text_input("姓名")
             n_phone = c2.text_input("手機")
@@ -460,41 +1924,99 @@ def show_general_management_dialog():
             n_grade = c3.selectbox("年級", GRADE_OPTIONS)
             n_course = c4.selectbox("班別", get_unique_course_names())
             if st.button("新增", key="btn_add_manual_stu"):
-                current_students.append({"姓名": n_name, "學生手機": n_phone, "年級": n_grade, "班別": n_course, "家裡":"", "爸爸":"", "媽媽":""})
+                if n_existing != "請選擇":
+                    src = next(s for s in current_students if s.get('sid') == n_existing.split("|")[0])
+                    new_row = {**{k: src.get(k, "") for k in ["姓名", "學生手機", "年級", "家裡", "爸爸", "媽媽"]}, "sid": src["sid"]}
+                else:
+                    new_row = {"sid": find_student_id(current_students, n_name, n_grade, n_phone), "姓名": n_name, "學生手機": n_phone, "年級": n_grade, "家裡":"", "爸爸":"", "媽媽":""}
+                current_students.append({**new_row, "班別": n_course, "joined_date": datetime.date.today().isoformat()})
                 save_students_data(current_students); st.rerun()
 
-        # 4. 列表與刪除
+        # 4. 出缺勤紀錄 (讀 roll_call_index)
+        with st.expander("📊 出缺勤紀錄"):
+            t_start, t_end, t_label = get_term_range(datetime.date.today())
+            c1, c2 = st.columns(2)
+            r_start = c1.date_input("起", t_start, key="att_start")
+            r_end = c2.date_input("迄", t_end, key="att_end")
+            st.caption(f"預設為本學期（{t_label}）")
+            stu_names = get_student_names(current_students)
+            sel_sid = st.selectbox("查詢學生", ["請選擇"] + sorted(stu_names, key=lambda k: stu_names[k]), format_func=lambda k: stu_names.get(k, k), key="att_student")
+            if sel_sid != "請選擇":
+                att = get_student_attendance(sel_sid)
+                in_range = {k: [d for d in v if r_start.isoformat() <= d <= r_end.isoformat()] for k, v in att.items()}
+                m1, m2, m3 = st.columns(3)
+                m1.metric("出席", len(in_range["present"])); m2.metric("請假", len(in_range["leave"])); m3.metric("未到", len(in_range["absent"]))
+                if in_range["leave"]: st.caption(f"請假：{'、'.join(in_range['leave'])}")
+                if in_range["absent"]: st.caption(f"未到：{'、'.join(in_range['absent'])}")
+            if st.button("📄 產生全體家長報告", key="btn_att_report"):
+                report = build_term_attendance_report(r_start, r_end)
+                st.dataframe(report, use_container_width=True, hide_index=True)
+                st.download_button("⬇️ 下載 CSV", report.to_csv(index=False).encode("utf-8-sig"), file_name=f"attendance_{r_start}_{r_end}.csv", mime="text/csv")
+
+        # 5. 名單報表 (依名單版本快取，匯出檔按下下載時才產生)
+        with st.expander("📑 名單報表"):
+            reports = get_current_roster_reports()
+            m1, m2, m3 = st.columns(3)
+            m1.metric("在班學生", int(reports["by_course_grade"]["合計"].iloc[-1]) if len(reports["by_course_grade"]) else 0)
+            m2.metric("本月離班", int(reports["monthly"]["離班"].iloc[-1]))
+            m3.metric("待退費", len(reports["refunds"]))
+            st.markdown("**班別 × 年級**")
+            st.dataframe(reports["by_course_grade"], use_container_width=True, hide_index=True)
+            st.markdown(f"**近 {REPORT_MONTHS} 個月入班 / 離班** (以班別人次計，入班日期不明者視為早於統計區間)")
+            st.dataframe(reports["monthly"], use_container_width=True, hide_index=True)
+            if len(reports["refunds"]):
+                st.markdown("**💸 待退費名單**")
+                st.dataframe(reports["refunds"].drop(columns="sid"), use_container_width=True, hide_index=True)
+                settled = st.multiselect("已完成退費", reports["refunds"]["sid"].unique().tolist(), key="refund_settle",
+                                         format_func=dict(zip(reports["refunds"]["sid"], reports["refunds"]["姓名"])).get)
+                if settled and st.button("確認已退費", key="btn_refund_settle"): settle_refunds(settled); st.rerun()
+            c1, c2 = st.columns(2)
+            r_kind = c1.selectbox("匯出報表", list(REPORT_KINDS), format_func=REPORT_KINDS.get, key="report_kind")
+            r_fmt = c2.radio("格式", ["xlsx", "csv"] if r_kind != "summary" else ["xlsx"], horizontal=True, key="report_fmt")
+            st.download_button("⬇️ 下載", functools.partial(export_roster_report, r_kind, r_fmt, current_tenant()),
+                               file_name=f"{REPORT_KINDS[r_kind]}_{datetime.date.today()}.{r_fmt}",
+                               mime="text/csv" if r_fmt == "csv" else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+        # 6. 列表與刪除
         if current_students:
             st.divider(); st.subheader("🔎 列表")
             
-            display_list = []
-            for s in current_students:
-                s_copy = s.copy()
-                if s.get('leaving_date'):
-                    s_copy['狀態'] = f"離班 ({s['leaving_date']})"
-                else:
-                    s_copy['狀態'] = "在班"
-                display_list.append(s_copy)
-
-            df_s = pd.DataFrame(display_list)
-            target_cols = ["姓名", "狀態", "年級", "班別", "學生手機", "爸爸", "媽媽", "家裡"]
-            for c in target_cols:
-                if c not in df_s.columns: df_s[c] = ""
-            df_s = df_s[target_cols]
-
-            f_class = st.selectbox("班別篩選", ["全部"] + sorted(list(set([x.get('班別') for x in current_students if x.get('班別')]))))
-            if f_class != "全部": df_s = df_s[df_s['班別'] == f_class]
+            c1, c2, c3 = st.columns([2, 1, 2])
+            f_class = c1.selectbox("班別篩選", ["全部"] + get_roster_courses())
+            f_status = c2.selectbox("狀態", ["全部", "在班", "離班"])
+            f_q = c3.text_input("搜尋", placeholder="姓名 / 班別 / 手機", key="roster_q")
+            c4, c5 = st.columns([2, 1])
+            f_sort = c4.selectbox("排序", ["姓名", "年級", "班別", "狀態"])
+            f_page = c5.number_input("頁", min_value=1, value=1, step=1, key="roster_page")
+            df_s, total, f_page = query_roster(f_class, f_q, f_status, f_sort, f_page, page_size=50)
             
-            st.dataframe(df_s, use_container_width=True, hide_index=True)
+            st.dataframe(df_s[ROSTER_COLUMNS], use_container_width=True, hide_index=True)
+            st.caption(f"共 {total} 筆，第 {f_page} / {max(1, -(-total // 50))} 頁")
             
             with st.expander("🗑️ 刪除資料 (慎用)"):
                 st.caption("此操作會完全刪除學生資料。若是學生不補了，建議使用上方的「辦理離班」功能。")
-                d_opts = [f"{r['姓名']} ({r.get('班別')})" for _, r in df_s.iterrows()]
-                to_del = st.multiselect("選擇刪除", d_opts)
+                to_del = roster_picker("選擇刪除", key="del_pick", multi=True)
                 if to_del and st.button("確認刪除", key="btn_del_manual_stu"):
-                    new_l = [s for s in current_students if f"{s['姓名']} ({s.get('班別')})" not in to_del]
+                    del_keys = set(to_del)
+                    new_l = [s for s in current_students if student_row_key(s) not in del_keys]
                     save_students_data(new_l); st.rerun()
 
+        # 6. 依異動紀錄還原名單 (管理員)
+        if st.session_state.get('is_admin'):
+            with st.expander("🕓 名單還原 (時間點)"):
+                c1, c2 = st.columns(2)
+                r_date = c1.date_input("日期", taipei_today(), key="restore_date")
+                r_time = c2.time_input("時間", datetime.time(9, 0), key="restore_time")
+                if st.checkbox("載入該時間點的名單", key="restore_load"):
+                    try: snapshot = reconstruct_state("settings", "students_detail", datetime.datetime.combine(r_date, r_time))
+                    except ValueError as e: snapshot = False; st.warning(str(e))
+                    if snapshot is False: pass
+                    elif not snapshot: st.caption("該時間點沒有名單資料")
+                    else:
+                        st.caption(f"該時間點共有 {len(snapshot.get('data', []))} 筆 (目前 {len(current_students)} 筆)")
+                        if st.button("確認還原", type="primary", key="btn_restore_students"):
+                            save_students_data(snapshot.get("data", []), helper="restore_students"); st.rerun()
+
     # --- Tab 2: 工讀生 ---
     with tab2:
         pts = get_part_timers_list_cached()
@@ -504,6 +2026,44 @@ def show_general_management_dialog():
         d_pt = st.multiselect("刪除", pts)
         if d_pt and st.button("確認刪", key="btn_del_pt"): save_part_timers_list([x for x in pts if x not in d_pt]); st.rerun()
 
+    # --- Tab: 課程目錄 ---
+    with tab_course:
+        catalog = get_course_catalog()
+        q = st.text_input("搜尋課程 (開頭文字)", key="course_search")
+        matches = search_courses(q)
+        sel_course = st.selectbox("課程", ["➕ 新增課程"] + matches, key="course_sel")
+        meta = catalog["courses"].get(sel_course, {})
+        weekdays = ["一", "二", "三", "四", "五", "六", "日"]
+        with st.form("course_form"):
+            c_name = st.text_input("課程名稱", "" if sel_course == "➕ 新增課程" else sel_course, disabled=sel_course != "➕ 新增課程")
+            c1, c2, c3 = st.columns(3)
+            bands = ["", "小", "國", "高"]
+            c_band = c1.selectbox("學制", bands, index=bands.index(meta.get("grade_band", "")) if meta.get("grade_band", "") in bands else 0, format_func=lambda b: b or "其他")
+            c_teacher = c2.text_input("預設老師", meta.get("default_teacher", ""))
+            c_loc = c3.text_input("上課地點", meta.get("location", ""))
+            # 每個時段各自的星期與起訖時間 (同一天可有多個時段)
+            slots = meta.get("weekly_slots", [])
+            day_labels = [f"週{w}" for w in weekdays]
+            time_opts = sorted(set(TIME_OPTIONS) | {t for x in slots for t in (x["start"], x["end"])})
+            st.caption("每週上課時段")
+            c_slots = st.data_editor(
+                pd.DataFrame([{"星期": day_labels[x["weekday"]], "開始": x["start"], "結束": x["end"]} for x in slots], columns=["星期", "開始", "結束"]),
+                num_rows="dynamic", hide_index=True, use_container_width=True, key=f"course_slots_{sel_course}",
+                column_config={"星期": st.column_config.SelectboxColumn("星期", options=day_labels, required=True),
+                               "開始": st.column_config.SelectboxColumn("開始", options=time_opts, required=True),
+                               "結束": st.column_config.SelectboxColumn("結束", options=time_opts, required=True)})
+            if st.form_submit_button("💾 儲存課程"):
+                new_slots = sorted(({"weekday": day_labels.index(r["星期"]), "start": r["開始"], "end": r["結束"]}
+                                    for r in c_slots.to_dict("records") if r["星期"] in day_labels and r["開始"] and r["結束"]),
+                                   key=lambda x: (x["weekday"], x["start"]))
+                if not c_name.strip(): st.error("請輸入課程名稱")
+                elif any(x["start"] >= x["end"] for x in new_slots): st.error("時段的結束時間需晚於開始時間")
+                else:
+                    save_course(c_name.strip(), grade_band=c_band, default_teacher=c_teacher, location=c_loc, weekly_slots=new_slots)
+                    st.toast("課程已儲存"); st.rerun()
+        if sel_course != "➕ 新增課程" and st.button("🗑️ 刪除此課程", key="btn_del_course"):
+            delete_course(sel_course); st.rerun()
+
     # --- Tab 3: 試聽與潛在名單 ---
     with tab3:
         st.subheader("🎧 試聽生管理 (未入班)")
@@ -570,22 +2130,88 @@ def show_general_management_dialog():
         st.info("點擊下方按鈕前往外部出題網站。")
         st.link_button("🚀 前往出題系統", "http://jutor-lecture.pages.dev/junior/english/admin", type="primary", use_container_width=True)
 
+@st.dialog("⚙️ 管理員後台", width="large")
+def show_admin_dialog():
+    # 總管理員看全部分校，分校管理員的統計、重算與薪資都只限自己的分校
+    cross = is_super_admin() and len(TENANTS) > 1
+    tenants = list(TENANTS) if cross else [current_tenant()]
+    st.subheader("🏢 各分校月統計" if cross else "🏢 本分校月統計")
+    today = datetime.date.today()
+    months = [(today.replace(day=1) - relativedelta(months=i)).strftime("%Y-%m") for i in range(12)]
+    month = st.selectbox("月份", months, key="rollup_month")
+    # 總表只讀各分校的月統計文件，由每日排程更新；需要最新數字時可手動重算
+    if st.button("🔄 重新統計此月份", key="rollup_refresh"):
+        for tenant in tenants:
+            with tenant_scope(tenant): compute_monthly_aggregates(month)
+        get_monthly_aggregates_cached.clear()
+    summary, payroll = build_tenant_rollup(month, tenants)
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+    st.markdown("**💰 老師薪資 (跨分校)**" if cross else "**💰 老師薪資**")
+    if payroll.empty: st.caption("此月份無授課紀錄")
+    else:
+        st.dataframe(payroll, use_container_width=True, hide_index=True)
+        st.download_button("⬇️ 下載 CSV", payroll.to_csv(index=False).encode("utf-8-sig"), file_name=f"payroll_{month}.csv", mime="text/csv")
+
+    st.divider()
+    st.subheader("📦 舊學期封存")
+    cutoff = archive_cutoff()
+    st.caption(f"保留最近 {tenant_config('archive_keep_terms', ARCHIVE_KEEP_TERMS)} 個學期，{cutoff} 之前的行程與點名紀錄每天由排程封存 (月統計不受影響)。")
+    terms = get_archive_meta_cached().get("terms", {})
+    rows = [{"資料": {"shifts": "行程", "roll_call_records": "點名"}[kind], "學期": get_term_range(datetime.date.fromisoformat(m["start"]))[2],
+             "筆數": m["count"], "封存時間": m["archived_at"][:16]} for kind in ARCHIVE_KINDS for t, m in sorted(terms.get(kind, {}).items())]
+    if rows: st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+    else: st.caption("尚無封存資料")
+    if st.button("📦 立即封存", key="archive_now"):
+        counts = archive_old_terms(cutoff)
+        st.success(f"已封存 行程 {counts.get('shifts', 0)} 筆、點名 {counts.get('roll_call_records', 0)} 筆")
+
+@st.fragment(run_every=10)
+def show_sync_status():
+    """離線寫入佇列的同步狀態，每 10 秒自動更新"""
+    q = get_write_queue()
+    sync = q.status()
+    if sync["pending"] and sync["error"]: st.caption(f":orange[⚠️ 連線中斷，{sync['pending']} 筆待同步]")
+    elif sync["pending"]: st.caption(f"🔄 {sync['pending']} 筆同步中")
+    elif sync["offline_reads"]: st.caption(":orange[📴 連線中斷，顯示上次讀到的資料]")
+    else: st.caption("☁️ 已同步")
+    if sync["dead"]:
+        # 重試多次仍失敗的寫入：列出內容，可重新同步或 (管理員) 捨棄
+        with st.popover(f":red[❌ {sync['dead']} 筆同步失敗]", use_container_width=True):
+            for w in q.dead():
+                label = {"roll_call": "點名", "cleaning": "清潔"}.get(w["kind"], w["kind"])
+                note = " · 已有較新的點名，不會重送" if w["superseded"] else ""
+                st.caption(f"{w['created_at'][:16]} {label} {w['doc_id']} ({w['actor']})：{w['last_error']}{note}")
+            c1, c2 = st.columns(2)
+            if c1.button("🔁 重新同步", key="dead_retry", use_container_width=True): q.retry_dead(); st.rerun(scope="fragment")
+            if st.session_state.get('is_admin') and c2.button("🗑️ 捨棄", key="dead_discard", use_container_width=True): q.discard_dead(); st.rerun(scope="fragment")
+
 # --- 5. 主介面邏輯 ---
 
 tz = pytz.timezone('Asia/Taipei')
 now = datetime.datetime.now(tz)
+get_scheduler()  # 啟動背景排程 (每個伺服器程序一個)
+get_write_queue()  # 啟動離線寫入同步 (程序重啟後繼續送出未同步的寫入)
 
-# 自動登出：僅在凌晨 06:00 ~ 06:30 之間
-if now.hour == 6 and now.minute <= 30 and st.session_state['user'] is not None:
-    st.session_state['user'] = None; st.session_state['is_admin'] = False; st.rerun()
+# 自動登出：排程每天 06:00 更新登出時間點，在那之前登入的工作階段需重新登入
+if st.session_state['user'] is not None:
+    if st.session_state['login_at'] is None: st.session_state['login_at'] = now.isoformat()
+    if st.session_state['login_at'] < get_logout_epoch():
+        st.session_state['user'] = None; st.session_state['is_admin'] = False; st.session_state['login_at'] = None; st.rerun()
 
 # 如果未登入，顯示登入區塊
 if st.session_state['user'] is None:
     st.title("🏫 鳩特數理行政班表")
     st.info("請先登入以使用系統")
     
+    # 分校在表單外選擇，切換後身份清單立即更新
+    tenant = DEFAULT_TENANT
+    if len(TENANTS) > 1:
+        tenant = st.selectbox("分校", list(TENANTS), format_func=lambda t: TENANTS[t].get("name", t), key="login_tenant")
+    login_list = tenant_config("login", LOGIN_LIST, tenant)
+    admins = tenant_config("admins", ADMINS, tenant)
+
     with st.form("main_login_form"):
-        user = st.selectbox("請選擇您的身份", ["請選擇"] + LOGIN_LIST)
+        user = st.selectbox("請選擇您的身份", ["請選擇"] + login_list)
         password = st.text_input("請輸入密碼", type="password")
         if st.form_submit_button("登入", use_container_width=True):
             if user == "請選擇":
@@ -593,35 +2219,41 @@ if st.session_state['user'] is None:
             else:
                 is_valid = False
                 is_admin = False
-                if user in ADMINS:
-                    if password == ADMIN_PASSWORD:
+                if user in admins:
+                    if password == tenant_config("admin_password", ADMIN_PASSWORD, tenant):
                         is_valid = True
                         is_admin = True
                 else:
-                    if password == STAFF_PASSWORD:
+                    if password == tenant_config("staff_password", STAFF_PASSWORD, tenant):
                         is_valid = True
                 
                 if is_valid:
+                    st.session_state['tenant'] = tenant
                     st.session_state['user'] = user
                     st.session_state['is_admin'] = is_admin
+                    st.session_state['login_at'] = datetime.datetime.now(tz).isoformat()
                     st.rerun()
                 else:
                     st.error("密碼錯誤")
     st.stop() 
 
 # 登入後顯示的內容
+ensure_roll_call_index()  # 首次啟動時完成學生 sid 遷移與點名索引回填
+ensure_announcements()
 col_title, col_login = st.columns([3, 1], vertical_alignment="center")
 with col_title: st.title("🏫 鳩特數理行政班表")
 with col_login:
-    st.markdown(f"👤 **{st.session_state['user']}**")
+    if len(TENANTS) > 1: st.markdown(f"👤 **{st.session_state['user']}** · {tenant_config('name', current_tenant())}")
+    else: st.markdown(f"👤 **{st.session_state['user']}**")
+    show_sync_status()
     if st.button("登出", type="secondary", use_container_width=True):
         st.session_state['user'] = None; st.session_state['is_admin'] = False; st.rerun()
 
 st.divider()
 
 # ★ 鳩辦公室增加完畢，並改為 5 欄 ★
-clean_cols = st.columns(5)
-areas = ["櫃檯茶水間", "大教室", "小教室", "流放教室", "鳩辦公室"]
+areas = tenant_config("cleaning_areas", CLEANING_AREAS)
+clean_cols = st.columns(len(areas))
 
 for i, area in enumerate(areas):
     status = get_cleaning_status(area)
@@ -645,15 +2277,8 @@ for i, area in enumerate(areas):
 
 st.divider()
 
-# ★ 試聽追蹤自動提醒 (放在最顯眼的位置) ★
-pending_trials = get_trial_students()
-follow_up_list = []
-for t in pending_trials:
-    try:
-        t_date = datetime.date.fromisoformat(t['trial_date'])
-        if datetime.date.today() >= (t_date + datetime.timedelta(days=7)):
-            follow_up_list.append(t)
-    except: pass
+# ★ 試聽追蹤自動提醒 (放在最顯眼的位置，清單由排程預先產生) ★
+follow_up_list = get_trial_follow_ups()
 
 if follow_up_list:
     st.markdown("### 🔔 試聽追蹤提醒")
@@ -687,64 +2312,27 @@ if col_date_btn.button("📅 切換日期", type="secondary"):
 if 'selected_calendar_date' in st.session_state:
     selected_date = st.session_state['selected_calendar_date']
 else:
-    selected_date = datetime.date.today()
+    selected_date = taipei_today()
 
 with col_date_info:
     st.markdown(f"**{selected_date}**")
 
 date_key = selected_date.isoformat()
-db_record = get_roll_call_from_db(date_key)
+db_record = get_roll_call_state(date_key)
 
-# 1. 抓取資料並建立「課程 -> 學生名單」的索引 (解決同名不同班問題)
+# 1. 當日課程、地點與應到學生 (已排除離班；今天的名單由排程預先算好)
 all_students = get_students_data_cached()
-course_to_students_map = defaultdict(list) 
-for s in all_students:
-    c = s.get('班別')
-    n = s.get('姓名')
-    if c and n:
-        # 改為儲存整個學生物件，以便後續判斷離班日
-        course_to_students_map[c].append(s)
-
-# 2. 準備當日課程 & 地點對照表 (這段要放在 all_events 之前，所以要先讀取 events)
-# 但因為點名需要 all_events，所以我們得先執行 get_all_events_cached()
-all_events = get_all_events_cached()
-
-daily_courses_display = []
-daily_courses_filter = []     
-course_location_map = {} 
-
-for e in all_events:
-    if e.get('start', '').startswith(date_key) and e.get('extendedProps', {}).get('type') == 'shift':
-        props = e.get('extendedProps', {})
-        c_title = props.get('title', '')
-        c_loc = props.get('location', '')
-        
-        if c_loc == "線上": c_loc = "櫃檯"
-        
-        daily_courses_filter.append(c_title)
-        course_location_map[c_title] = c_loc
-        
-        if c_loc: daily_courses_display.append(f"{c_title} ({c_loc})")
-        else: daily_courses_display.append(c_title)
+plan = get_roll_call_plan(date_key)
+daily_courses_filter = plan["courses"]
+course_location_map = plan["locations"]
+target_students = plan["targets"]
 
-# 3. 抓取「現在課表上」應到的學生 (加入離班判斷)
-target_students = []
-if daily_courses_display:
+if daily_courses_filter:
+    daily_courses_display = [f"{c} ({course_location_map[c]})" if course_location_map.get(c) else c for c in daily_courses_filter]
     st.caption(f"當日課程：{'、'.join(daily_courses_display)}")
-    for c_name in daily_courses_filter:
-        student_objs = course_to_students_map.get(c_name, [])
-        for s_obj in student_objs:
-            # 判斷是否已離班
-            leave_date = s_obj.get('leaving_date')
-            if leave_date and date_key > leave_date:
-                continue # 已離班，跳過
-            
-            target_students.append(s_obj['姓名'])
 else:
     st.caption("當日無排課紀錄")
 
-target_students = list(set(target_students))
-
 # 決定當前點名狀態 (含自動同步邏輯)
 if db_record:
     current_data = db_record
@@ -753,7 +2341,7 @@ if db_record:
     if "leave" not in current_data: current_data["leave"] = []
     
     # 自動同步：補入漏掉的學生
-    recorded_students = set(current_data["absent"] + current_data["present"] + current_data["leave"])
+    recorded_students = set(current_data["absent"]) | set(current_data["present"]) | set(current_data["leave"])
     missing_students = [s for s in target_students if s not in recorded_students]
     
     if missing_students:
@@ -761,15 +2349,22 @@ if db_record:
 else:
     current_data = {"absent": target_students, "present": [], "leave": []}
 
+# sid -> 顯示名稱 (已不在名單中的學生以紀錄內的 labels 顯示)
+student_names = get_student_names(all_students, current_data.get("labels"))
+student_labels = {**current_data.get("labels", {}), **{s['sid']: s.get('姓名', '') for s in all_students if s.get('sid')}}
+def name_of(sid): return student_names.get(sid, sid)
+
 def save_current_state(absent, present, leave):
     save_data = {
         "absent": absent,
         "present": present,
         "leave": leave,
+        "labels": {sid: student_labels.get(sid, "") for sid in absent + present + leave},
+        "schema": 2,
         "updated_at": datetime.datetime.now().isoformat(),
         "updated_by": st.session_state['user']
     }
-    save_roll_call_to_db(date_key, save_data)
+    enqueue_roll_call(date_key, current_data, save_data)
     st.toast("點名資料已儲存", icon="💾")
     time.sleep(0.5)
     st.rerun()
@@ -793,15 +2388,8 @@ if st.session_state['user']:
             sorted_today_courses = sorted(list(set(daily_courses_filter)))
             
             for course_name in sorted_today_courses:
-                # 從物件列表中取出姓名，一樣要做離班過濾 (雖然 target_students 已經濾過了，但為了顯示分類安全起見)
-                student_objs = course_to_students_map.get(course_name, [])
-                students_in_this_course = []
-                for s_obj in student_objs:
-                    leave_date = s_obj.get('leaving_date')
-                    if leave_date and date_key > leave_date: continue
-                    students_in_this_course.append(s_obj['姓名'])
-                
-                s_list = [s for s in students_in_this_course if s in pending_list]
+                students_in_this_course = plan["course_students"].get(course_name, [])
+                s_list = list(dict.fromkeys(s for s in students_in_this_course if s in pending_list))
                 
                 if s_list:
                     displayed_students.update(s_list)
@@ -815,11 +2403,13 @@ if st.session_state['user']:
                             f"pills_present_{course_name}",
                             options=s_list,
                             selection_mode="multi",
+                            format_func=name_of,
                             key=f"pills_p_{course_name}_{date_key}",
                             label_visibility="collapsed"
                         )
                         
-                        remaining_for_leave = [s for s in s_list if s not in selected_p]
+                        selected_p_set = set(selected_p)
+                        remaining_for_leave = [s for s in s_list if s not in selected_p_set]
                         
                         if remaining_for_leave:
                             st.markdown("**👇 點擊請假學生 (假)**")
@@ -827,6 +2417,7 @@ if st.session_state['user']:
                                 f"pills_leave_{course_name}",
                                 options=remaining_for_leave,
                                 selection_mode="multi",
+                                format_func=name_of,
                                 key=f"pills_l_{course_name}_{date_key}",
                                 label_visibility="collapsed"
                             )
@@ -834,17 +2425,18 @@ if st.session_state['user']:
                         
                         all_selected_present.extend(selected_p)
 
-            leftover_students = [s for s in pending_list if s not in displayed_students]
+            leftover_students = sorted((s for s in pending_list if s not in displayed_students), key=name_of)
             if leftover_students:
                 with st.expander(f"❓ 其他 / 未分類 ({len(leftover_students)}人)", expanded=True):
                     st.caption("這些學生不在今日排定的課程名單中，但出現在未到列表")
                     st.markdown("**👇 點擊出席學生 (到)**")
-                    l_p = st.pills("pills_other_p", options=leftover_students, selection_mode="multi", key=f"p_other_{date_key}")
+                    l_p = st.pills("pills_other_p", options=leftover_students, selection_mode="multi", format_func=name_of, key=f"p_other_{date_key}")
                     
-                    rem_l = [s for s in leftover_students if s not in l_p]
+                    l_p_set = set(l_p)
+                    rem_l = [s for s in leftover_students if s not in l_p_set]
                     if rem_l:
                         st.markdown("**👇 點擊請假學生 (假)**")
-                        l_l = st.pills("pills_other_l", options=rem_l, selection_mode="multi", key=f"l_other_{date_key}")
+                        l_l = st.pills("pills_other_l", options=rem_l, selection_mode="multi", format_func=name_of, key=f"l_other_{date_key}")
                         all_selected_leave.extend(l_l)
                     all_selected_present.extend(l_p)
 
@@ -853,13 +2445,14 @@ if st.session_state['user']:
             if st.button("🚀 確認送出 (更新狀態)", type="primary", use_container_width=True):
                 conflict = set(all_selected_present) & set(all_selected_leave)
                 if conflict:
-                    st.error(f"錯誤：{', '.join(conflict)} 不能同時選取")
+                    st.error(f"錯誤：{', '.join(name_of(s) for s in conflict)} 不能同時選取")
                 elif not all_selected_present and not all_selected_leave:
                     st.warning("您未選取任何學生")
                 else:
-                    new_absent = [p for p in current_data['absent'] if p not in all_selected_present and p not in all_selected_leave]
-                    new_present = current_data['present'] + all_selected_present
-                    new_leave = current_data['leave'] + all_selected_leave
+                    chosen = set(all_selected_present) | set(all_selected_leave)
+                    new_absent = [p for p in current_data['absent'] if p not in chosen]
+                    new_present = current_data['present'] + list(dict.fromkeys(all_selected_present))
+                    new_leave = current_data['leave'] + list(dict.fromkeys(all_selected_leave))
                     save_current_state(new_absent, new_present, new_leave)
         else:
             st.success("🎉 全員已完成點名！")
@@ -870,22 +2463,24 @@ if st.session_state['user']:
         with st.expander(f"已到 ({len(current_data['present'])}) / 請假 ({len(current_data['leave'])})", expanded=False):
             if current_data['present']:
                 st.write("**🟢 已到 (點選以取消)**")
-                undo_p = st.pills("undo_present", options=current_data['present'], selection_mode="multi", key=f"undo_p_{date_key}", label_visibility="collapsed")
+                undo_p = st.pills("undo_present", options=current_data['present'], selection_mode="multi", format_func=name_of, key=f"undo_p_{date_key}", label_visibility="collapsed")
                 if undo_p:
                     if st.button("↩️ 還原選取的學生 (移回未到)", key="btn_undo_p"):
-                        new_present = [p for p in current_data['present'] if p not in undo_p]
+                        undo_set = set(undo_p)
+                        new_present = [p for p in current_data['present'] if p not in undo_set]
                         new_absent = current_data['absent'] + undo_p
                         save_current_state(new_absent, new_present, current_data['leave'])
             
             if current_data['leave']:
                 st.divider()
                 st.write("**🟡 請假 (點選以取消)**")
-                undo_l = st.pills("undo_leave", options=current_data['leave'], selection_mode="multi", key=f"undo_l_{date_key}", label_visibility="collapsed")
+                undo_l = st.pills("undo_leave", options=current_data['leave'], selection_mode="multi", format_func=name_of, key=f"undo_l_{date_key}", label_visibility="collapsed")
                 if undo_l:
                     if st.button("↩️ 還原選取的學生 (移回未到)", key="btn_undo_l"):
-                        new_leave = [p for p in current_data['leave'] if p not in undo_l]
+                        undo_set = set(undo_l)
+                        new_leave = [p for p in current_data['leave'] if p not in undo_set]
                         new_absent = current_data['absent'] + undo_l
-                        save_current_state(current_data['absent'], current_data['present'], new_leave)
+                        save_current_state(new_absent, current_data['present'], new_leave)
 
 else:
     st.warning("請登入以進行點名")
@@ -894,7 +2489,28 @@ else:
 st.divider()
 st.subheader("📅 行事曆")
 
-# 這裡使用我們之前準備好的 all_events
+# 公告摘要：近兩週考試與未完成任務
+today_str = datetime.date.today().isoformat()
+col_exam, col_task = st.columns(2)
+with col_exam:
+    st.markdown("**📝 近 14 天考試**")
+    exams = get_announcements_cached("考試", today_str, (datetime.date.today() + datetime.timedelta(days=14)).isoformat(), limit=5)
+    for n in exams: st.caption(f"{n['date']}　{n['title']}")
+    if not exams: st.caption("無")
+with col_task:
+    st.markdown("**🔥 未完成任務**")
+    tasks = get_announcements_cached("任務", open_only=True, limit=5)
+    for n in tasks: st.caption(f"{n['date']}　{n['title']}")
+    if not tasks: st.caption("無")
+
+all_events = get_all_events_cached() + get_notice_badge_events()
+# 已封存的學期需選擇後才讀取
+archived_terms = get_archive_meta_cached().get("terms", {}).get("shifts", {})
+view_term = None
+if archived_terms:
+    view_term = st.selectbox("📦 查看已封存學期", [None] + sorted(archived_terms, reverse=True),
+                             format_func=lambda t: "目前學期" if t is None else get_term_range(datetime.date.fromisoformat(t + "-01"))[2], key="calendar_archived_term")
+    if view_term: all_events += get_archived_events(archived_terms[view_term]["start"], archived_terms[view_term]["end"])
 calendar_options = {
     "editable": True, 
     "headerToolbar": {
@@ -916,9 +2532,10 @@ calendar_options = {
     },
     "selectable": True,
 }
-cal = calendar(events=all_events, options=calendar_options, callbacks=['dateClick', 'eventClick'])
+if view_term: calendar_options["initialDate"] = archived_terms[view_term]["start"]
+cal = calendar(events=all_events, options=calendar_options, callbacks=['dateClick', 'eventClick'], key=f"calendar_{view_term or 'current'}")
 
-# 點擊日期：只開公告
+# 點擊日期：列出當天公告 (含已完成的任務) 並可新增
 if cal.get("dateClick"):
     clicked = cal["dateClick"]["date"]
     try:
@@ -929,9 +2546,12 @@ if cal.get("dateClick"):
             d_obj = dt_utc.astimezone(pytz.timezone('Asia/Taipei')).date()
         else: d_obj = datetime.datetime.strptime(clicked, "%Y-%m-%d").date()
         
-        if st.session_state['user']: show_notice_dialog(default_date=d_obj)
+        if st.session_state['user']: show_day_notices_dialog(d_obj.isoformat())
     except: pass
 
 if cal.get("eventClick"):
     if st.session_state['user']:
-        show_edit_event_dialog(cal["eventClick"]["event"]["id"], cal["eventClick"]["event"]["extendedProps"])
+        props = cal["eventClick"]["event"]["extendedProps"]
+        if props.get("type") == "notice_badge": show_day_notices_dialog(props["date"])
+        elif props.get("archived"): st.toast("已封存的行程無法修改", icon="📦")
+        else: show_edit_event_dialog(cal["eventClick"]["event"]["id"], props)